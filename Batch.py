@@ -0,0 +1,138 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import product
+from Tools import Tools
+from Planet import Planet
+from Cache import Cache
+from Diagnostics import Diagnostics
+import numpy as np
+import argparse
+import json
+import time
+import os
+
+
+class Batch:
+    # Headless porkchop sweeps. Reads a job manifest, solves every job with Tools.Transfer.solve on
+    # a pool of processes, and writes each result to the output directory as soon as it is done:
+    # a compressed .npz of the grids plus a .json of metadata, including the job's Diagnostics. The
+    # .json is written last, so a job counts as finished only once both files exist and an
+    # interrupted run can simply be restarted.
+
+    ## Manifest format (JSON):
+    # {
+    #     "k": 1.32712440018e11,                         (optional, defaults to the Sun)
+    #     "jobs": [
+    #         {"db": "Earth", "ab": "Mars", "dd": ["2022-07-01", "2022-11-01"],
+    #          "ad": ["2023-01-01", "2024-01-01"], "d_inc": 2,
+    #          "bounds": {"c3": 40, "dv": 20}},                (optional, skips cells above every bound)
+    #         {"db": ["Earth"], "ab": ["Mars", "Venus"], ...}    (lists expand to every pair)
+    #     ]
+    # }
+
+    k = 1.32712440018e11 # Gravitational parameter of main attractor (heliocentric) [km^3/s^2]
+
+    @classmethod
+    def expand(cls, manifest):
+        # Takes a manifest and returns the flat list of jobs it describes, expanding body lists
+        # into every departure/arrival pair of distinct bodies.
+
+        jobs = []
+        for entry in manifest["jobs"]:
+            departures = entry["db"] if isinstance(entry["db"], list) else [entry["db"]]
+            arrivals = entry["ab"] if isinstance(entry["ab"], list) else [entry["ab"]]
+            for db, ab in product(departures, arrivals):
+                if db != ab:
+                    job = dict(entry, db=db, ab=ab)
+                    job.setdefault("k", manifest.get("k", cls.k))
+                    job.setdefault("d_inc", 1)
+                    jobs.append(job)
+        return jobs
+
+    @staticmethod
+    def name(job):
+        # A stable, readable file name for a job.
+
+        parts = [job["k"], job["db"], job["ab"], job["dd"], job["ad"], job["d_inc"]]
+        key = Cache.key(*parts + ([sorted(job["bounds"].items())] if job.get("bounds") else []))
+        return "%s-%s-%s-%s" % (job["db"], job["ab"], job["dd"][0], key[:12])
+
+    @classmethod
+    def done(cls, job, out):
+        return os.path.exists(os.path.join(out, cls.name(job) + ".json"))
+
+    @classmethod
+    def run(cls, job, out):
+        # Solves a single job and writes its .npz (the arrays of a Tools.Transfer.Result) and .json to
+        # out. Returns the metadata.
+
+        start = time.time()
+        Diagnostics.reset()
+        dd, jdd = Tools.Date.getRange(job["dd"][0], job["dd"][1], job["d_inc"])
+        ad, jad = Tools.Date.getRange(job["ad"][0], job["ad"][1], job["d_inc"])
+        result = Tools.Transfer.solve(job["k"], Planet(job["db"]), Planet(job["ab"]), jdd, jad, workers=1,
+                                      bounds=job.get("bounds"))
+
+        file = os.path.join(out, cls.name(job))
+        with open(file + ".npz.tmp", "wb") as f:
+            np.savez_compressed(f, **result.arrays())
+        os.replace(file + ".npz.tmp", file + ".npz")
+
+        meta = {
+            "job": job,
+            "shape": list(result.metrics.shape[1:]),
+            "metrics": list(Tools.Transfer.Result.names),
+            "skipped": result.skipped,
+            "diagnostics": Diagnostics.snapshot(),
+            "elapsed": time.time() - start,
+            "finished": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+        with open(file + ".json.tmp", "w") as f:
+            json.dump(meta, f, indent=2)
+        os.replace(file + ".json.tmp", file + ".json")
+
+        return meta
+
+    @staticmethod
+    def prepare(jobs):
+        # Writes the state lattice of every distinct (body, dates) pair among jobs before they are
+        # handed out, so that jobs sharing a body and dates, ie: every Earth departure of a sweep,
+        # memory-map the same states instead of each interpolating their own.
+
+        lattices = set()
+        for job in jobs:
+            for body, dates in ((job["db"], job["dd"]), (job["ab"], job["ad"])):
+                lattices.add((body, dates[0], dates[1], job["d_inc"]))
+        for body, start, end, d_inc in sorted(lattices, key=str):
+            Planet(body).getStates(Tools.Date.getRange(start, end, d_inc)[1])
+
+    @classmethod
+    def main(cls, argv=None):
+        parser = argparse.ArgumentParser(description="Solve porkchop grids for every job in a manifest.")
+        parser.add_argument("manifest", help="path to the JSON job manifest")
+        parser.add_argument("-o", "--out", default="results", help="output directory (default: results)")
+        parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(),
+                            help="number of jobs solved in parallel (default: all cores)")
+        args = parser.parse_args(argv)
+
+        with open(args.manifest) as f:
+            jobs = cls.expand(json.load(f))
+        os.makedirs(args.out, exist_ok=True)
+
+        pending = [job for job in jobs if not cls.done(job, args.out)]
+        print("%d jobs, %d already done" % (len(jobs), len(jobs) - len(pending)))
+        cls.prepare(pending)
+
+        with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            futures = {pool.submit(cls.run, job, args.out): job for job in pending}
+            for n, future in enumerate(as_completed(futures), 1):
+                job = futures[future]
+                try:
+                    meta = future.result()
+                except Exception as error:
+                    print("[%d/%d] %s failed: %s" % (n, len(pending), cls.name(job), error))
+                    continue
+                print("[%d/%d] %s done in %.1f s" % (n, len(pending), cls.name(job), meta["elapsed"]))
+
+
+if __name__ == "__main__":
+    Batch.main()
@@ -0,0 +1,239 @@
+from Tools import Tools, lambert
+from Planet import Planet, Ephemeris
+from Cache import Cache
+from Lambert import Lambert
+from functools import partial
+import numpy as np
+import subprocess
+import sys
+import tracemalloc
+import argparse
+import platform
+import tempfile
+import json
+import time
+import os
+
+
+class Benchmark:
+    # Reproducible timings of the hot paths: date ranges, ephemeris lookup, the scalar and batched
+    # Lambert solvers, full porkchop solves (cold and cached) and figure building. Every case is
+    # run offline against the local kernel, timed as the best of a few repeats, and its peak traced
+    # memory recorded. Results are written as JSON together with the commit they were taken at, so
+    # runs can be compared across commits.
+
+    ## Variables:
+    # k       = gravitational parameter of the Sun [km^3/s^2]
+    # windows = named (departure body, arrival body, departure dates, arrival dates, increment)
+    # config  = plot configuration used for the figure building cases
+
+    k = 1.32712440018e11
+
+    windows = {
+        "earth-mars-1": ("Earth", "Mars", ("2022-07-01", "2022-11-01"), ("2023-01-01", "2024-01-01"), 1),
+        "earth-mars-2": ("Earth", "Mars", ("2022-07-01", "2022-11-01"), ("2023-01-01", "2024-01-01"), 2),
+        "earth-mars-10": ("Earth", "Mars", ("2022-07-01", "2022-11-01"), ("2023-01-01", "2024-01-01"), 10),
+        "earth-neptune-10": ("Earth", "Neptune", ("2022-01-01", "2024-01-01"), ("2032-01-01", "2052-01-01"), 10),
+    }
+
+    config = {
+        "c3_ub": 40, "vinf_ub": 15, "dv_ub": 20,
+        "c3_lbl": True, "vinf_lbl": True, "dv_lbl": True, "tof_lbl": True,
+        "inc": 1, "tof_inc": 50,
+        "plt_size": {"width": 800, "height": 550},
+        "make_plt": {"c3": True, "vinf": True, "dv": True, "tof": False},
+    }
+
+    @staticmethod
+    def measure(function, repeat=3):
+        # Runs function repeat times and returns the best wall time [s] and the peak memory traced
+        # during the first run [bytes].
+
+        tracemalloc.start()
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            function()
+            times.append(time.perf_counter() - start)
+        return min(times), peak
+
+    @classmethod
+    def window(cls, name):
+        db, ab, dd, ad, d_inc = cls.windows[name]
+        dd, jdd = Tools.Date.getRange(dd[0], dd[1], d_inc)
+        ad, jad = Tools.Date.getRange(ad[0], ad[1], d_inc)
+        return Planet(db), Planet(ab), dd, jdd, ad, jad
+
+    @classmethod
+    def cases(cls, workers):
+        # Yields (name, function, number of lambert solves) for every benchmark case.
+
+        Body0, Body1, dd, jdd, ad, jad = cls.window("earth-mars-1")
+        yield "getRange", lambda: Tools.Date.getRange("2022-01-01", "2032-01-01", 1), 0
+
+        juldates = np.linspace(jdd[0], jdd[0] + 3652.5, 100000)
+        Body0.getCoords(juldates[:1]) # build the state table outside of the timing
+        yield "getCoords-100k", lambda: Body0.getCoords(juldates), 0
+        yield "getStates-100k", lambda: Body0.getStates(juldates), 0
+
+        rP0, vP0 = Body0.getCoords(jdd[:1])
+        rP1, vP1 = Body1.getCoords(jad[150:151])
+        tof = (jad[150] - jdd[0]) * 86400
+        if lambert is not None and Tools.Transfer.solveLambert(cls.k, rP0[:, 0], rP1[:, 0], vP0[:, 0], vP1[:, 0], tof)[0] is not None:
+            yield "solveLambert-100", lambda: [
+                Tools.Transfer.solveLambert(cls.k, rP0[:, 0], rP1[:, 0], vP0[:, 0], vP1[:, 0], tof)
+                for _ in range(100)], 200
+
+        # Both Lambert engines on the same cells, the compiled one warmed up first:
+        r0, r1, _, _, tofs = cls.cells("earth-mars-1")
+        for engine in ("numpy", "numba") if Lambert.available else ("numpy",):
+            Lambert.solve(cls.k, r0[:1], r1[:1], tofs[:1])
+            yield "lambertBatch-%s" % engine, partial(cls.engine, engine, r0, r1, tofs), 2 * len(tofs)
+
+        for name in cls.windows:
+            Body0, Body1, dd, jdd, ad, jad = cls.window(name)
+            rP0, vP0 = (a.T for a in Body0.getCoords(jdd))
+            rP1, vP1 = (a.T for a in Body1.getCoords(jad))
+            tofs = np.subtract.outer(jad, jdd)
+            cells = tofs.size
+
+            yield "solveGrid-%s" % name, partial(
+                Tools.Transfer.solveGrid, cls.k, rP0, rP1, vP0, vP1, tofs, 1), 2 * cells
+            if workers > 1:
+                yield "solveGrid-%s-x%d" % (name, workers), partial(
+                    Tools.Transfer.solveGrid, cls.k, rP0, rP1, vP0, vP1, tofs, workers), 2 * cells
+
+        # End-to-end solves against an empty, private disk cache:
+        Body0, Body1, dd, jdd, ad, jad = cls.window("earth-mars-2")
+        solve = partial(Tools.Transfer.solve, cls.k, Body0, Body1, jdd, jad, workers)
+        path = Cache.path
+        with tempfile.TemporaryDirectory() as Cache.path:
+            def cold():
+                for root, _, files in os.walk(Cache.path):
+                    for file in files:
+                        os.remove(os.path.join(root, file))
+                Ephemeris.lattices.clear()
+                return solve()
+
+            yield "solve-earth-mars-2-cold", cold, 2 * len(jdd) * len(jad)
+            yield "solve-earth-mars-2-cached", solve, 0
+
+            yield "porkchop-earth-mars-2", partial(Tools.Plot.figure, cls.config, dd, ad, *solve().grids()), 0
+        Cache.path = path
+
+    @classmethod
+    def cells(cls, name):
+        # Flat arrays of departure, arrival body states [km, km/s] and flight times [s] of every cell
+        # of a window.
+
+        Body0, Body1, dd, jdd, ad, jad = cls.window(name)
+        di, ai = (index.ravel() for index in np.meshgrid(np.arange(len(jdd)), np.arange(len(jad))))
+        rP0, vP0 = (a.T[di] for a in Body0.getCoords(jdd))
+        rP1, vP1 = (a.T[ai] for a in Body1.getCoords(jad))
+        return rP0, rP1, vP0, vP1, (np.asarray(jad)[ai] - np.asarray(jdd)[di]) * 86400
+
+    @classmethod
+    def engine(cls, engine, r0, r1, tofs):
+        # Solves both transfer types of every cell with the given Lambert engine.
+
+        default, Tools.Transfer.engine = Tools.Transfer.engine, engine
+        try:
+            return [Tools.Transfer.lambertBatch(cls.k, r0, r1, tofs, short) for short in (True, False)]
+        finally:
+            Tools.Transfer.engine = default
+
+    @classmethod
+    def validate(cls, samples=2000, rtol=1e-7):
+        # Compares the Lambert engines on random cells of every window against poliastro, through
+        # solveLambert. Prints the largest relative difference in C3 and V infinity and the number
+        # of cells where only one side failed, and returns whether every engine agreed within rtol.
+
+        if lambert is None: # the reference
+            print("poliastro is not installed, cannot validate the Lambert engines", file=sys.stderr)
+            return False
+
+        rng = np.random.default_rng(0)
+        states = [np.concatenate(arrays) for arrays in zip(*(cls.cells(name) for name in cls.windows))]
+        cells = rng.choice(len(states[-1]), min(samples, len(states[-1])), replace=False)
+        rP0, rP1, vP0, vP1, tofs = (array[cells] for array in states)
+
+        def metrics(pairs):
+            # c3s0, c3l0, vinfs1, vinfl1 as a (4, N) array
+            (vs0, vs1), (vl0, vl1) = pairs
+            return np.stack((np.sum((vs0 - vP0)**2, axis=-1), np.sum((vl0 - vP0)**2, axis=-1),
+                             np.linalg.norm(vs1 - vP1, axis=-1), np.linalg.norm(vl1 - vP1, axis=-1)))
+
+        expected = np.array([Tools.Transfer.solveLambert(cls.k, rP0[i], rP1[i], vP0[i], vP1[i], tofs[i])[:4]
+                             for i in range(len(tofs))], dtype=float).T # failures come back as None, ie: NaN
+
+        passed = True
+        for engine in ("numpy", "numba") if Lambert.available else ("numpy",):
+            actual = metrics(cls.engine(engine, rP0, rP1, tofs))
+            mismatched = np.count_nonzero(np.isnan(actual) != np.isnan(expected))
+            with np.errstate(invalid="ignore", divide="ignore"):
+                error = np.abs(actual - expected) / np.abs(expected)
+            error = error[~np.isnan(error)] # cells both sides failed
+            error = error.max() if error.size else 0.0
+            passed &= bool(error <= rtol and not mismatched)
+            print("%-6s vs poliastro %6d transfers, largest relative difference %.3g, %d failure mismatches" % (
+                engine, 2 * len(tofs), error, mismatched))
+        return passed
+
+    @staticmethod
+    def commit():
+        try:
+            return subprocess.check_output(
+                ["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=subprocess.DEVNULL).decode().strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    @classmethod
+    def main(cls, argv=None):
+        parser = argparse.ArgumentParser(description="Benchmark the solver, ephemeris and plotting hot paths.")
+        parser.add_argument("-o", "--out", default="bench_results.json", help="results file (default: bench_results.json)")
+        parser.add_argument("-r", "--repeat", type=int, default=3, help="timed runs per case (default: 3)")
+        parser.add_argument("-w", "--workers", type=int, default=os.cpu_count(),
+                            help="worker processes for the parallel cases (default: all cores)")
+        parser.add_argument("-k", "--filter", default="", help="only run cases whose name contains this string")
+        parser.add_argument("--validate", action="store_true",
+                            help="check the Lambert engines against poliastro instead of timing anything")
+        args = parser.parse_args(argv)
+
+        if args.validate:
+            sys.exit(0 if cls.validate() else 1)
+
+        Tools.Transfer.pool_size = max(Tools.Transfer.pool_size, args.workers)
+        results = []
+        for name, function, solves in cls.cases(args.workers):
+            if args.filter not in name:
+                continue
+            seconds, peak = cls.measure(function, args.repeat)
+            results.append({
+                "case": name,
+                "seconds": seconds,
+                "lambert_per_second": solves / seconds if solves else None,
+                "peak_bytes": peak,
+            })
+            print("%-36s %10.4f s %14s lambert/s %10.1f MB" % (
+                name, seconds, "%.0f" % (solves / seconds) if solves else "-", peak / 2**20))
+
+        with open(args.out, "w") as f:
+            json.dump({
+                "commit": cls.commit(),
+                "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "python": platform.python_version(),
+                "numpy": np.__version__,
+                "machine": platform.machine(),
+                "cpus": os.cpu_count(),
+                "workers": args.workers,
+                "results": results,
+            }, f, indent=2)
+
+
+if __name__ == "__main__":
+    Benchmark.main()
@@ -0,0 +1,139 @@
+from Diagnostics import Diagnostics
+import numpy as np
+import tempfile
+import hashlib
+import os
+
+
+class Cache:
+    # A content-addressed, on-disk store for solved grids. Entries are written as compressed .npz
+    # archives named by a hash of everything that determines their contents, so they survive
+    # restarts and are shared by every server process pointed at the same directory. The total
+    # size is bounded; once exceeded, the least recently used entries are evicted.
+
+    ## Variables:
+    # path      = cache directory, MISSION_PLANNER_CACHE or .cache next to this file
+    # max_bytes = size bound of the cache directory, MISSION_PLANNER_CACHE_MB megabytes
+
+    path = os.environ.get(
+        "MISSION_PLANNER_CACHE",
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), ".cache")
+    )
+    max_bytes = int(os.environ.get("MISSION_PLANNER_CACHE_MB", 2048)) * 2**20
+
+    @staticmethod
+    def key(*parts):
+        # Hashes an arbitrary sequence of scalars, strings and arrays into a hex digest. Arrays are
+        # hashed by dtype, shape and raw bytes, never by repr.
+
+        digest = hashlib.sha256()
+        for part in parts:
+            if isinstance(part, (np.ndarray, list, tuple)):
+                part = np.ascontiguousarray(part)
+                digest.update(str((part.dtype.str, part.shape)).encode())
+                digest.update(part.tobytes())
+            else:
+                digest.update(repr(part).encode())
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    @classmethod
+    def file(cls, namespace, key):
+        return os.path.join(cls.path, namespace, key + ".npz")
+
+    @classmethod
+    def keys(cls, namespace):
+        # Returns the keys stored in a namespace, most recently used first.
+
+        directory = os.path.join(cls.path, namespace)
+        try:
+            files = [name for name in os.listdir(directory) if name.endswith(".npz")]
+        except OSError:
+            return []
+
+        mtimes = {}
+        for name in files:
+            try:
+                mtimes[name[:-4]] = os.path.getmtime(os.path.join(directory, name))
+            except OSError:
+                continue
+        return sorted(mtimes, key=mtimes.get, reverse=True)
+
+    @classmethod
+    def load(cls, namespace, key, names=None, touch=True):
+        # Returns a dict of the arrays stored under key, or None on a miss. Passing names only
+        # decompresses those members. Unless touch is False, a hit refreshes the entry's
+        # modification time, which is what eviction orders by, and the lookup is counted in
+        # Diagnostics as a cache hit or miss.
+
+        file = cls.file(namespace, key)
+        kind = namespace.split(os.sep)[0]
+        try:
+            with np.load(file) as data:
+                arrays = {name: data[name] for name in (names or data.files)}
+        except (OSError, ValueError, EOFError, KeyError):
+            if touch:
+                Diagnostics.count("cache.miss." + kind)
+            return None
+
+        if touch:
+            Diagnostics.count("cache.hit." + kind)
+            try:
+                os.utime(file)
+            except OSError:
+                pass
+        return arrays
+
+    @classmethod
+    def save(cls, namespace, key, **arrays):
+        # Stores arrays under key. The archive is written to a temporary file first and moved into
+        # place, so concurrent readers never see a partial entry.
+
+        cls.write(cls.file(namespace, key), lambda f: np.savez_compressed(f, **arrays))
+        cls.evict()
+
+    @staticmethod
+    def write(file, writer):
+        # Calls writer with a temporary binary file next to file and moves it into place. Every
+        # call gets its own temporary file, so concurrent writers of the same file, threads of one
+        # process included, never clobber each other: the last rename wins and each one leaves a
+        # complete file behind.
+
+        directory = os.path.dirname(file)
+        os.makedirs(directory, exist_ok=True)
+        handle, temp = tempfile.mkstemp(prefix=os.path.basename(file) + ".", suffix=".tmp", dir=directory)
+        try:
+            with os.fdopen(handle, "wb") as f:
+                writer(f)
+            os.replace(temp, file)
+        except BaseException:
+            try:
+                os.remove(temp)
+            except OSError:
+                pass
+            raise
+
+    @classmethod
+    def evict(cls):
+        # Removes least recently used entries until the cache fits in max_bytes. The memory-mapped
+        # state lattices under "states" count as entries too, the ephemeris tables do not.
+
+        entries = []
+        for root, _, files in os.walk(cls.path):
+            for name in files:
+                if name.endswith(".npz") or (name.endswith(".npy") and os.path.basename(root) == "states"):
+                    try:
+                        stat = os.stat(os.path.join(root, name))
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, file in sorted(entries):
+            if total <= cls.max_bytes:
+                break
+            try:
+                os.remove(file)
+            except OSError:
+                continue
+            total -= size
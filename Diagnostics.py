@@ -0,0 +1,170 @@
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+import threading
+import atexit
+import json
+import time
+import sys
+import os
+
+
+class Diagnostics:
+    # Process-wide instrumentation of the hot paths. Instrumented code wraps its stages in
+    # Diagnostics.stage("name") and bumps counters with Diagnostics.count("name"); both are cheap
+    # enough to stay on everywhere. snapshot() returns everything recorded since the last reset()
+    # as plain JSON-able dicts, which headless runs write next to their results. Work done inside
+    # pool worker processes is recorded by the parent around the pool call, not inside the
+    # workers. Callers sharing a process, like the app's Streamlit sessions (one thread each),
+    # use start() instead, which records what the calling thread does into a Run of its own.
+
+    ## Stages and counters:
+    # ephemeris, ephemeris.build         = state lookups, state table builds
+    # ephemeris.lattice.hit, .miss       = state lattices served from memory or disk, interpolated
+    # solve.prune, solve.overlap         = feasibility pre-pass, search for a reusable grid
+    # solve.lambert                      = lambert solves of a grid, all processes included
+    # plot.porkchop, plot.figure         = cached figure (st.cache hashing included), figure building
+    # cache.hit.*, cache.miss.*          = disk cache lookups by namespace
+    # lambert.calls, lambert.failed      = direct (type 1 and 2) solves, those that failed to converge
+    # solve.skipped                      = cells skipped by the pre-pass
+
+    ## Profiler:
+    # Setting MISSION_PLANNER_PROFILE to a file name starts a sampling profiler: a daemon thread
+    # records the stack of every other thread each MISSION_PLANNER_PROFILE_MS milliseconds
+    # (default 10) and the collapsed stacks are written to that file at exit, ready for
+    # flamegraph.pl or speedscope. Only the main process is sampled. Each sample walks the stack
+    # of every thread, so its cost grows with the number of threads, ie: open app sessions.
+
+    timings = defaultdict(lambda: [0, 0.0, 0.0]) # name: [calls, total seconds, longest call]
+    counters = Counter()
+    samples = Counter()
+    _lock = threading.Lock()
+    _local = threading.local()
+    _profiler = None
+
+    class Run:
+        # Timings and counters recorded by one thread since Diagnostics.start.
+
+        def __init__(self):
+            self.timings = defaultdict(lambda: [0, 0.0, 0.0])
+            self.counters = Counter()
+
+        def snapshot(self):
+            with Diagnostics._lock:
+                return Diagnostics.summary(self.timings, self.counters)
+
+    @classmethod
+    def start(cls):
+        # Returns a new Run recording everything the calling thread does from now on, on top of
+        # the process-wide figures, until the thread calls start again.
+
+        cls._local.run = cls.Run()
+        return cls._local.run
+
+    @classmethod
+    def recorders(cls):
+        run = getattr(cls._local, "run", None)
+        return (cls, run) if run is not None else (cls,)
+
+    @classmethod
+    @contextmanager
+    def stage(cls, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            cls.record(name, time.perf_counter() - start)
+
+    @classmethod
+    def record(cls, name, elapsed):
+        # Records one call of stage name that took elapsed seconds, for time that is not spent in
+        # one block, ie: waits spread across the yields of a generator.
+
+        with cls._lock:
+            for recorder in cls.recorders():
+                timing = recorder.timings[name]
+                timing[0] += 1
+                timing[1] += elapsed
+                timing[2] = max(timing[2], elapsed)
+
+    @classmethod
+    def count(cls, name, n=1):
+        with cls._lock:
+            for recorder in cls.recorders():
+                recorder.counters[name] += int(n)
+
+    @classmethod
+    def reset(cls):
+        with cls._lock:
+            cls.timings.clear()
+            cls.counters.clear()
+
+    @classmethod
+    def snapshot(cls):
+        # Returns the timings [s] and counters recorded since the last reset.
+
+        with cls._lock:
+            return cls.summary(cls.timings, cls.counters)
+
+    @staticmethod
+    def summary(timings, counters):
+        return {
+            "timings": {name: {"calls": calls, "seconds": total, "longest": longest}
+                        for name, (calls, total, longest) in sorted(timings.items())},
+            "counters": dict(sorted(counters.items())),
+        }
+
+    @classmethod
+    def export(cls, file, **extra):
+        # Writes a snapshot, plus any extra fields, to file as JSON.
+
+        with open(file, "w") as f:
+            json.dump(dict(cls.snapshot(), timestamp=time.strftime("%Y-%m-%dT%H:%M:%S"), **extra), f, indent=2)
+
+    @classmethod
+    def profile(cls, file, interval=0.01):
+        # Starts the sampling profiler, see above. Does nothing if it is already running.
+
+        with cls._lock:
+            if cls._profiler is not None:
+                return
+            cls._profiler = threading.Thread(target=cls.sample, args=(interval,), name="profiler", daemon=True)
+            cls._profiler.start()
+        atexit.register(cls.dump, file)
+
+    @classmethod
+    def sample(cls, interval):
+        own = threading.get_ident()
+        while True:
+            time.sleep(interval)
+            for thread, frame in sys._current_frames().items():
+                if thread == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append("%s:%s" % (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name))
+                    frame = frame.f_back
+                with cls._lock:
+                    cls.samples[";".join(reversed(stack))] += 1
+
+    @classmethod
+    def top(cls, n=20):
+        # The n functions seen most often at the top of a sampled stack, with their sample counts.
+
+        functions = Counter()
+        with cls._lock:
+            for stack, hits in cls.samples.items():
+                functions[stack.rsplit(";", 1)[-1]] += hits
+        return functions.most_common(n)
+
+    @classmethod
+    def dump(cls, file):
+        # Writes the sampled stacks to file in collapsed stack format.
+
+        with cls._lock:
+            lines = ["%s %d\n" % (stack, hits) for stack, hits in cls.samples.most_common()]
+        with open(file, "w") as f:
+            f.writelines(lines)
+
+
+if os.environ.get("MISSION_PLANNER_PROFILE"):
+    Diagnostics.profile(os.environ["MISSION_PLANNER_PROFILE"], float(os.environ.get("MISSION_PLANNER_PROFILE_MS", 10)) / 1000)
@@ -1,4 +1,7 @@
 import streamlit as st
+import os
+
+from Tools import Tools
 
 class Initialize():
 
@@ -46,7 +49,11 @@ class Initialize():
             arr_cols = st.columns(2)
             arrival0 = arr_cols[0].text_input('Earliest Arrival', '2023-01-01')
             arrival1 = arr_cols[1].text_input('Latest Arrival', '2024-01-01')
-            d_inc = st.text_input("Calculation Increment (days)", '2')
+            d_inc = st.text_input("Calculation Increment (days, or hours ie: 6h)", '2')
+            workers = st.text_input("Worker Processes", str(os.cpu_count() or 1))
+            adaptive = st.checkbox("Adaptive Refinement", value=False)
+            coarse_inc = st.text_input("Coarse Increment (days)", '10')
+            max_revs = st.text_input("Max Revolutions", '0')
 
         plot_settings = st.sidebar.expander(label="Plot Settings")
         with plot_settings:
@@ -68,6 +75,8 @@ class Initialize():
             plt_cols = st.columns(3)
             inc = plt_cols[0].text_input('Contours', 1)
             tof_inc = plt_cols[1].text_input('TOF Lines', 50)
+
+        diagnostics = st.sidebar.checkbox("Show Diagnostics", value=False)
     
     # Configure the solver and plotter:
         config = {
@@ -77,7 +86,11 @@ class Initialize():
             "k"        : 1.32712440018e11, # Gravitational parameter of main attractor (heliocentric) [km^3/s^2]
             "dd"       : [departure0, departure1], # Departure Dates Array
             "ad"       : [arrival0, arrival1], # Arrival Dates Array
-            "d_inc"    : int(d_inc), # Date Increment (ie: for a given date range, d_inc = 1 calculates a transfer every day, d_inc = 2 calculates a transfer every two days and so on)
+            "d_inc"    : Tools.Date.days(d_inc), # Date Increment [days] (ie: for a given date range, d_inc = 1 calculates a transfer every day, d_inc = 2 every two days, d_inc = 0.25 or "6h" every six hours and so on)
+            "workers"  : int(workers), # Number of processes the porkchop grid is split across
+            "adaptive" : adaptive, # Solve a coarse grid first and only refine cells near the contour upper bounds
+            "coarse_inc" : int(coarse_inc), # Date increment of the coarse grid for adaptive refinement
+            "max_revs" : int(max_revs), # Largest number of full revolutions considered per transfer (0 = direct transfers only)
 
             # Plot Settings:
             "c3_ub"    : int(c3_ub), # plot upper bound for displaying c3 contour lines
@@ -92,6 +105,9 @@ class Initialize():
             "tof_inc"  : int(tof_inc), # Increment between lines of constant flight time
 
             "plt_size" : {"width" : 800, "height" : 550}, # Size of the Porkhop Plot (width (index = 0) currently unused)
+            "plt_pts"  : 400, # Maximum number of grid points plotted along each axis
+            "redraw"   : 1.0, # Minimum time between redraws of a partially solved plot [s]
+            "diagnostics" : diagnostics, # Show stage timings and counters below the plot
             "make_plt" : {"c3": show_c3, "vinf" : show_vinf, "dv" : show_dv, "tof" : show_tof} # Check which plots to make, type: [bool, bool, bool, bool]
         }
 
@@ -0,0 +1,120 @@
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError: # numba is optional, Tools.Transfer falls back to its numpy solver without it
+    njit = None
+
+
+def stumpff(psi):
+    # Stumpff functions c2(psi) and c3(psi), with the same series around zero as
+    # Tools.Transfer.stumpff.
+
+    if psi > 1.0:
+        sq = np.sqrt(psi)
+        return (1 - np.cos(sq)) / psi, (sq - np.sin(sq)) / (psi * sq)
+    if psi < -1.0:
+        sq = np.sqrt(-psi)
+        return (np.cosh(sq) - 1) / -psi, (np.sinh(sq) - sq) / (-psi * sq)
+
+    term2, term3 = 1 / 2, 1 / 6
+    c2, c3 = term2, term3
+    for n in range(1, 12):
+        term2 = term2 * -psi / ((2 * n + 1) * (2 * n + 2))
+        term3 = term3 * -psi / ((2 * n + 2) * (2 * n + 3))
+        c2 += term2
+        c3 += term3
+    return c2, c3
+
+
+def vallado(k, r0, r1, tof, short, numiter, rtol, v0, v1):
+    # Vallado's universal variable algorithm for a single transfer, step for step the one in
+    # poliastro.iod.vallado and Tools.Transfer.lambertBatch, on plain floats [km, s]. Writes the
+    # departure and arrival velocities into v0, v1 [km/s], NaN where poliastro would raise.
+
+    ## Variables:
+    # A   = geometry constant of the transfer, signed by transfer type
+    # psi = universal variable, bracketed by psi_low and psi_up
+
+    v0[:] = np.nan
+    v1[:] = np.nan
+
+    norm_r0 = np.sqrt(r0[0]**2 + r0[1]**2 + r0[2]**2)
+    norm_r1 = np.sqrt(r1[0]**2 + r1[1]**2 + r1[2]**2)
+    norm_r0_times_norm_r1 = norm_r0 * norm_r1
+    norm_r0_plus_norm_r1 = norm_r0 + norm_r1
+    cos_dnu = (r0[0] * r1[0] + r0[1] * r1[1] + r0[2] * r1[2]) / norm_r0_times_norm_r1
+    A = (1.0 if short else -1.0) * np.sqrt(norm_r0_times_norm_r1 * (1 + cos_dnu))
+
+    # A phase angle of 180 degrees or a non-positive flight time has no solution:
+    if A == 0.0 or not np.isfinite(A) or not tof > 0.0:
+        return
+
+    psi, psi_low, psi_up = 0.0, -4 * np.pi**2, 4 * np.pi**2
+    for count in range(numiter):
+        c2, c3 = stumpff(psi)
+        y = norm_r0_plus_norm_r1 + A * (psi * c3 - 1) / np.sqrt(c2)
+
+        # Readjust psi_low until y > 0.0 (only for A > 0.0):
+        if A > 0.0 and y < 0.0:
+            for _ in range(numiter):
+                psi_low = psi
+                psi = 0.8 * (1.0 / c3) * (1.0 - norm_r0_times_norm_r1 * np.sqrt(c2) / A)
+                c2, c3 = stumpff(psi)
+                y = norm_r0_plus_norm_r1 + A * (psi * c3 - 1) / np.sqrt(c2)
+                if not y < 0.0:
+                    break
+            if y < 0.0:
+                return
+
+        xi = np.sqrt(y / c2)
+        tof_new = (xi**3 * c3 + A * np.sqrt(y)) / np.sqrt(k)
+
+        # Convergence check, then bisection:
+        if np.abs((tof_new - tof) / tof) < rtol:
+            f = 1 - y / norm_r0
+            g = A * np.sqrt(y / k)
+            gdot = 1 - y / norm_r1
+            for i in range(3):
+                v0[i] = (r1[i] - f * r0[i]) / g
+                v1[i] = (gdot * r1[i] - r0[i]) / g
+            return
+
+        if tof_new <= tof:
+            psi_low = psi
+        else:
+            psi_up = psi
+        psi = (psi_low + psi_up) / 2
+
+
+def batch(k, r0, r1, tof, short, numiter, rtol, v0, v1):
+    for i in range(tof.shape[0]):
+        vallado(k, r0[i], r1[i], tof[i], short, numiter, rtol, v0[i], v1[i])
+
+
+if njit is not None:
+    stumpff = njit(cache=True)(stumpff)
+    vallado = njit(cache=True)(vallado)
+    batch = njit(cache=True)(batch)
+
+
+class Lambert:
+    # Compiled Lambert solver. The kernel above is plain Python over floats, which numba compiles
+    # to machine code (cached next to this file after the first run) when it is installed; there
+    # are no units, no generators and no per-call allocation. Tools.Transfer uses it as its
+    # "numba" engine, see Tools.Transfer.engine.
+
+    available = njit is not None
+
+    @staticmethod
+    def solve(k, r0, r1, tof, short=True, numiter=35, rtol=1e-8):
+        # Drop-in counterpart of Tools.Transfer.lambertBatch: takes (N, 3) positions [km] and (N,)
+        # flight times [s] and returns (N, 3) departure and arrival velocities [km/s].
+
+        r0 = np.ascontiguousarray(r0, dtype=float).reshape(-1, 3)
+        r1 = np.ascontiguousarray(r1, dtype=float).reshape(-1, 3)
+        tof = np.ascontiguousarray(tof, dtype=float).reshape(-1)
+        v0 = np.empty_like(r0)
+        v1 = np.empty_like(r1)
+        batch(float(k), r0, r1, tof, bool(short), int(numiter), float(rtol), v0, v1)
+        return v0, v1
@@ -1,5 +1,190 @@
 from jplephem.spk import SPK
-kernel = SPK.open('de440s.bsp')
+from Cache import Cache
+from Diagnostics import Diagnostics
+import numpy as np
+import threading
+import os
+
+class Ephemeris:
+    # Precomputed heliocentric state tables. The first time a body is requested, its barycenter
+    # minus the Sun is sampled from the SPK kernel at a fixed step over the kernel's whole span and
+    # written to the cache directory as a .npy file. Every later lookup, in this or any other
+    # process, memory-maps that file and interpolates, without touching the kernel. The kernel
+    # itself is only opened when a table has to be built, and then only the segments of the
+    # requested body and the Sun are read.
+
+    ## Variables:
+    # kernel_path  = SPK file, MISSION_PLANNER_EPHEMERIS or de440s.bsp in the working directory,
+    #                falling back to the directory of this file
+    # steps        = table step per body number [days], finer for the faster inner planets
+    # path         = directory holding the tables
+    # tables       = memory-mapped tables by file name, columns: jd, x, y, z, vx, vy, vz [km, km/day]
+    # lattices     = memory-mapped states of a body on a given array of dates, see lattice
+    # max_lattices = lattices kept mapped per process, least recently used dropped first
+
+    kernel_path = os.environ.get("MISSION_PLANNER_EPHEMERIS", "de440s.bsp")
+    if not os.path.isabs(kernel_path) and not os.path.exists(kernel_path):
+        kernel_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), kernel_path)
+
+    steps = {1: 0.25, 2: 0.5, 3: 1.0, 4: 1.0, 5: 4.0, 6: 4.0, 7: 4.0, 8: 4.0, 9: 4.0}
+    sun = 10
+    path = os.path.join(Cache.path, "ephemeris")
+    tables = {}
+    lattices = {}
+    max_lattices = 64
+    _kernel = None
+    _lock = threading.Lock()
+    _kernel_lock = threading.Lock()
+    _lattice_lock = threading.Lock()
+
+    @classmethod
+    def kernel(cls):
+        # Returns the process-wide SPK kernel, opening it on first use.
+
+        with cls._kernel_lock:
+            if cls._kernel is None:
+                cls._kernel = SPK.open(cls.kernel_path)
+            return cls._kernel
+
+    @classmethod
+    def identity(cls):
+        # A short tag of the kernel in use, from its path, size and modification time, that goes
+        # into the name of everything derived from it (tables, lattices and cached grids), so
+        # pointing at another kernel or updating this one never serves stale states. Just the file
+        # name when the kernel is missing, ie: when only prebuilt tables are shipped.
+
+        try:
+            stat = os.stat(cls.kernel_path)
+        except OSError:
+            return os.path.basename(cls.kernel_path)
+        return "%s-%s" % (os.path.basename(cls.kernel_path),
+                          Cache.key(os.path.abspath(cls.kernel_path), stat.st_size, stat.st_mtime_ns)[:12])
+
+    @classmethod
+    def table(cls, num):
+        # Returns the state table of body number num, building it on first use.
+
+        name = "%s-%d-%g.npy" % (cls.identity(), num, cls.steps[num])
+        with cls._lock:
+            if name not in cls.tables:
+                file = os.path.join(cls.path, name)
+                if not os.path.exists(file):
+                    cls.build(num, file)
+                cls.tables[name] = np.load(file, mmap_mode="r")
+            return cls.tables[name]
+
+    @classmethod
+    def build(cls, num, file):
+        # Samples heliocentric states of body number num over the span shared by its segment and
+        # the Sun's and saves them to file.
+
+        with Diagnostics.stage("ephemeris.build"):
+            kernel = cls.kernel()
+            body = kernel[0, num]
+            sun = kernel[0, cls.sun]
+            start = np.ceil(max(body.start_jd, sun.start_jd))
+            end = np.floor(min(body.end_jd, sun.end_jd))
+            jd = np.arange(start, end + cls.steps[num] / 2, cls.steps[num])
+
+            r, v = body.compute_and_differentiate(jd)
+            r_sun, v_sun = sun.compute_and_differentiate(jd)
+            table = np.column_stack((jd, (r - r_sun).T, (v - v_sun).T))
+
+        Cache.write(file, lambda f: np.save(f, table))
+
+    @classmethod
+    def lattice(cls, num, juldates):
+        # Returns the heliocentric position and velocity of body number num on juldates as
+        # read-only (N, 3) arrays [km, km/s], shared by every grid on the same dates. The states
+        # are interpolated once, saved under the cache directory as a .npy file keyed by the body,
+        # the table and the dates, and memory-mapped from there, so other grids, sessions and
+        # batch workers on the same dates get views of the same pages instead of their own copies.
+
+        jd = np.ascontiguousarray(juldates, dtype=float).ravel()
+        key = Cache.key(cls.identity(), num, cls.steps[num], jd)
+        states = cls.mapped(key)
+        if states is not None:
+            Diagnostics.count("ephemeris.lattice.hit")
+            return states[0], states[1]
+
+        # One thread maps or builds lattices at a time, the others then find them mapped:
+        with cls._lattice_lock:
+            states = cls.mapped(key)
+            if states is not None:
+                Diagnostics.count("ephemeris.lattice.hit")
+                return states[0], states[1]
+
+            file = os.path.join(Cache.path, "states", key + ".npy")
+            try:
+                states = np.load(file, mmap_mode="r")
+                Diagnostics.count("ephemeris.lattice.hit")
+            except (OSError, ValueError, EOFError):
+                Diagnostics.count("ephemeris.lattice.miss")
+                r, v = cls.states(num, jd)
+                built = np.stack((r.T, v.T / 86400))
+                Cache.write(file, lambda f: np.save(f, built))
+                try:
+                    states = np.load(file, mmap_mode="r")
+                except (OSError, ValueError, EOFError): # evicted by another process meanwhile
+                    states = built
+                    states.flags.writeable = False
+            try:
+                os.utime(file)
+            except OSError:
+                pass
+
+            with cls._lock:
+                cls.lattices[key] = states
+                while len(cls.lattices) > cls.max_lattices:
+                    cls.lattices.pop(next(iter(cls.lattices)))
+        return states[0], states[1]
+
+    @classmethod
+    def mapped(cls, key):
+        # Returns the lattice mapped under key, marking it most recently used, or None.
+
+        with cls._lock:
+            states = cls.lattices.pop(key, None)
+            if states is not None:
+                cls.lattices[key] = states
+            return states
+
+    @classmethod
+    def states(cls, num, juldates):
+        # Takes an array of julian dates and returns the heliocentric position and velocity of body
+        # number num as (3, N) arrays [km, km/day], by cubic Hermite interpolation of the table.
+
+        ## Variables:
+        # i    = index of the table row at or before each date
+        # s    = normalized time within the table step, 0 <= s <= 1
+        # h**  = Hermite basis functions, dh** their derivatives with respect to s
+
+        table = cls.table(num)
+        jd = np.atleast_1d(np.asarray(juldates, dtype=float))
+        jd0, step = table[0, 0], table[1, 0] - table[0, 0]
+
+        x = (jd - jd0) / step
+        if np.any(x < 0) or np.any(x > len(table) - 1):
+            raise ValueError("Julian dates outside of the ephemeris span (%s to %s)" % (jd0, table[-1, 0]))
+
+        i = np.minimum(x.astype(int), len(table) - 2)
+        s = (x - i)[:, np.newaxis]
+        p0, v0 = table[i, 1:4], table[i, 4:7] * step
+        p1, v1 = table[i + 1, 1:4], table[i + 1, 4:7] * step
+
+        h00 = (1 + 2 * s) * (1 - s)**2
+        h10 = s * (1 - s)**2
+        h01 = s**2 * (3 - 2 * s)
+        h11 = s**2 * (s - 1)
+        dh00 = 6 * s**2 - 6 * s
+        dh10 = 3 * s**2 - 4 * s + 1
+        dh01 = 6 * s - 6 * s**2
+        dh11 = 3 * s**2 - 2 * s
+
+        r = h00 * p0 + h10 * v0 + h01 * p1 + h11 * v1
+        v = (dh00 * p0 + dh10 * v0 + dh01 * p1 + dh11 * v1) / step
+
+        return r.T, v.T
 
 class Planet:
     # Instantiating a Planet object with the name of the planet ie: Earth = Planet("Earth") 
@@ -19,19 +204,54 @@ class Planet:
         "Pluto"   : 9
     }
 
+    # Gravitational parameters [km^3/s^2] and mean radii [km] of each planet, used for flybys:
+    mu = {
+        "Mercury" : 2.2031868551e4,
+        "Venus"   : 3.24858592e5,
+        "Earth"   : 3.98600435507e5,
+        "Mars"    : 4.2828375816e4,
+        "Jupiter" : 1.26712764100e8,
+        "Saturn"  : 3.7940584841e7,
+        "Uranus"  : 5.794556400e6,
+        "Neptune" : 6.836527101e6,
+        "Pluto"   : 9.75500000e2
+    }
+
+    radius = {
+        "Mercury" : 2439.7,
+        "Venus"   : 6051.8,
+        "Earth"   : 6371.0,
+        "Mars"    : 3389.5,
+        "Jupiter" : 69911.0,
+        "Saturn"  : 58232.0,
+        "Uranus"  : 25362.0,
+        "Neptune" : 24622.0,
+        "Pluto"   : 1188.3
+    }
+
     properties = {}
 
     def __init__(self, body):
 
         self.properties = {
-            "name" : body,
-            "num"  : self.options[body]
+            "name"   : body,
+            "num"    : self.options[body],
+            "mu"     : self.mu[body],
+            "radius" : self.radius[body]
         }
 
     def getCoords(self, juldates):
-        # Takes an array of julian dates and returns the position and velocity
-        # vectors of the instantiated planet.     
+        # Takes an array of julian dates and returns the heliocentric position and velocity
+        # vectors of the instantiated planet, interpolated from its Ephemeris table.
+
+        with Diagnostics.stage("ephemeris"):
+            r, v = Ephemeris.states(self.properties["num"], juldates)
+
+        return r, v/86400 # [km, km/s]
 
-        r, v = kernel[0,self.properties["num"]].compute_and_differentiate(juldates)
+    def getStates(self, juldates):
+        # Like getCoords, but returns read-only (N, 3) arrays from the shared Ephemeris lattice of
+        # these dates, for the date ranges of porkchop grids that many grids have in common.
 
-        return r, v/86400 # [km, km/s]
\ No newline at end of file
+        with Diagnostics.stage("ephemeris"):
+            return Ephemeris.lattice(self.properties["num"], juldates) # [km, km/s]
\ No newline at end of file
@@ -0,0 +1,229 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ProcessPoolExecutor
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError
+from Tools import Tools
+from Planet import Planet
+from Cache import Cache
+import numpy as np
+import threading
+import argparse
+import json
+import io
+import os
+
+
+class Service:
+    # A local compute service, so that many planners (Streamlit sessions, scripts, other tools) can
+    # share one pool of solver processes and one result cache. Requests are JSON objects POSTed to
+    # one of the endpoints below; array results come back as an .npz archive when the request
+    # sends "Accept: application/x-npz", and as JSON (NaN as null) otherwise. Identical requests
+    # that arrive while one is already being computed wait for that one instead of queueing up a
+    # copy. Solved grids land in the shared disk Cache, so repeated requests are served from it.
+
+    ## Endpoints:
+    # POST /solve     {"db", "ab", "jdd", "jad", "k", "max_revs", "bounds"}    >> Result arrays
+    # POST /refine    {"db", "ab", "jdd", "jad", "bounds", "stride", "margin", "k", "max_revs"}
+    #                                                                           >> Result arrays
+    # POST /optimize  {"db", "ab", "jdd": [first, last], "jad": [first, last], "metric",
+    #                  "coarse_inc", "k"}                                       >> optimum, JSON
+    # POST /ephemeris {"body", "jd"}                                            >> "r" [km], "v" [km/s]
+    # GET  /health                                                              >> pool status, JSON
+    # Keys other than db/ab/body and the dates are optional. Dates are julian dates.
+
+    ## Variables:
+    # k           = default gravitational parameter of the Sun [km^3/s^2]
+    # workers     = size of the process pool, MISSION_PLANNER_SERVICE_WORKERS or all cores
+    # max_pending = most distinct jobs queued or running at once; more are refused with a 503
+    # max_body    = largest accepted request [bytes]
+
+    k = 1.32712440018e11
+    workers = int(os.environ.get("MISSION_PLANNER_SERVICE_WORKERS", 0)) or os.cpu_count() or 1
+    max_pending = 64
+    max_body = 16 * 2**20
+
+    _pool = None
+    _inflight = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def compute(cls, endpoint, params):
+        # Runs one request in a pool process and returns its response as a dict, of arrays for the
+        # grid and ephemeris endpoints. Each process solves with a single worker; parallelism comes
+        # from the pool.
+
+        k = params.get("k", cls.k)
+        if endpoint == "ephemeris":
+            r, v = Planet(params["body"]).getCoords(np.asarray(params["jd"], dtype=float))
+            return {"r": r, "v": v}
+
+        Body0, Body1 = Planet(params["db"]), Planet(params["ab"])
+        jdd = np.asarray(params["jdd"], dtype=float)
+        jad = np.asarray(params["jad"], dtype=float)
+        if endpoint == "solve":
+            return Tools.Transfer.solve(k, Body0, Body1, jdd, jad, 1, params.get("max_revs", 0),
+                                        params.get("bounds")).arrays()
+        if endpoint == "refine":
+            return Tools.Transfer.refine(k, Body0, Body1, jdd, jad, params["bounds"], params.get("stride", 8),
+                                         params.get("margin", 0.25), 1, params.get("max_revs", 0)).arrays()
+        if endpoint == "optimize":
+            return Tools.Transfer.optimize(k, Body0, Body1, jdd, jad, params.get("metric", "dv"),
+                                           params.get("coarse_inc", 10), workers=1)
+        raise KeyError("Unknown endpoint /%s" % endpoint)
+
+    @classmethod
+    def submit(cls, endpoint, params):
+        # Returns the future of a request, joining an identical one already in flight if there is
+        # one. Raises OverflowError once max_pending distinct jobs are queued or running.
+
+        key = Cache.key(endpoint, json.dumps(params, sort_keys=True))
+        with cls._lock:
+            future = cls._inflight.get(key)
+            if future is not None:
+                return future
+            if len(cls._inflight) >= cls.max_pending:
+                raise OverflowError("Too many pending jobs, try again later")
+            if cls._pool is None:
+                cls._pool = ProcessPoolExecutor(max_workers=cls.workers)
+            future = cls._pool.submit(cls.compute, endpoint, params)
+            cls._inflight[key] = future
+
+        # Outside of the lock, as the callback runs right away if the job is already done:
+        future.add_done_callback(lambda _: cls.release(key))
+        return future
+
+    @classmethod
+    def release(cls, key):
+        with cls._lock:
+            cls._inflight.pop(key, None)
+
+    @staticmethod
+    def encode(result, npz):
+        # Serializes a response, returning (content type, body).
+
+        if npz and isinstance(result, dict) and any(isinstance(value, np.ndarray) for value in result.values()):
+            buffer = io.BytesIO()
+            np.savez(buffer, **result)
+            return "application/x-npz", buffer.getvalue()
+
+        def plain(value):
+            if isinstance(value, np.ndarray) and value.dtype.kind == "f":
+                value = value.astype(object)
+                value[value != value] = None # NaN
+            return value.tolist() if isinstance(value, (np.ndarray, np.generic)) else value
+
+        if isinstance(result, dict):
+            result = {name: plain(value) for name, value in result.items()}
+        return "application/json", json.dumps(result).encode()
+
+    class Handler(BaseHTTPRequestHandler):
+        # Maps HTTP requests onto Service.submit.
+
+        def do_GET(self):
+            if self.path.rstrip("/") != "/health":
+                return self.reply(404, {"error": "Not found"})
+            with Service._lock:
+                pending = len(Service._inflight)
+            self.reply(200, {"status": "ok", "workers": Service.workers, "pending": pending,
+                             "max_pending": Service.max_pending})
+
+        def do_POST(self):
+            endpoint = self.path.strip("/")
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                if length > Service.max_body:
+                    return self.reply(413, {"error": "Request too large"})
+                params = json.loads(self.rfile.read(length) or b"{}")
+                if endpoint not in ("solve", "refine", "optimize", "ephemeris"):
+                    return self.reply(404, {"error": "Unknown endpoint /%s" % endpoint})
+                result = Service.submit(endpoint, params).result()
+            except OverflowError as error:
+                return self.reply(503, {"error": str(error)})
+            except (ValueError, KeyError, TypeError) as error:
+                return self.reply(400, {"error": "%s: %s" % (type(error).__name__, error)})
+            except Exception as error:
+                return self.reply(500, {"error": "%s: %s" % (type(error).__name__, error)})
+            self.reply(200, result, "application/x-npz" in self.headers.get("Accept", ""))
+
+        def reply(self, status, result, npz=False):
+            content_type, body = Service.encode(result, npz)
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    class Client:
+        # Calls a running Service, mirroring the Tools.Transfer and Planet methods it exposes.
+
+        def __init__(self, url, timeout=3600):
+            self.url = url.rstrip("/")
+            self.timeout = timeout
+
+        def request(self, endpoint, params, npz=True):
+            request = Request(self.url + "/" + endpoint, data=json.dumps(params).encode(), headers={
+                "Content-Type": "application/json",
+                "Accept": "application/x-npz" if npz else "application/json",
+            })
+            try:
+                with urlopen(request, timeout=self.timeout) as response:
+                    body, content_type = response.read(), response.headers.get("Content-Type", "")
+            except HTTPError as error:
+                raise RuntimeError("Service error %d: %s" % (error.code, error.read().decode(errors="replace")))
+            if content_type == "application/x-npz":
+                with np.load(io.BytesIO(body)) as data:
+                    return {name: data[name] for name in data.files}
+            return json.loads(body)
+
+        @staticmethod
+        def dates(jdd, jad):
+            return [float(jd) for jd in np.ravel(jdd)], [float(jd) for jd in np.ravel(jad)]
+
+        def solve(self, k, Body0, Body1, jdd, jad, max_revs=0, bounds=None):
+            jdd, jad = self.dates(jdd, jad)
+            return Tools.Transfer.Result.fromArrays(self.request("solve", {
+                "k": k, "db": Body0.properties["name"], "ab": Body1.properties["name"], "jdd": jdd, "jad": jad,
+                "max_revs": max_revs, "bounds": bounds}))
+
+        def refine(self, k, Body0, Body1, jdd, jad, bounds, stride=8, margin=0.25, max_revs=0):
+            jdd, jad = self.dates(jdd, jad)
+            return Tools.Transfer.Result.fromArrays(self.request("refine", {
+                "k": k, "db": Body0.properties["name"], "ab": Body1.properties["name"], "jdd": jdd, "jad": jad,
+                "bounds": bounds, "stride": stride, "margin": margin, "max_revs": max_revs}))
+
+        def optimize(self, k, Body0, Body1, jdd, jad, metric="dv", coarse_inc=10):
+            jdd, jad = self.dates(jdd, jad)
+            return self.request("optimize", {
+                "k": k, "db": Body0.properties["name"], "ab": Body1.properties["name"], "jdd": jdd, "jad": jad,
+                "metric": metric, "coarse_inc": coarse_inc}, npz=False)
+
+        def getCoords(self, Body, juldates):
+            states = self.request("ephemeris", {"body": Body.properties["name"], "jd": self.dates(juldates, [])[0]})
+            return states["r"], states["v"]
+
+    @classmethod
+    def main(cls, argv=None):
+        parser = argparse.ArgumentParser(description="Serve porkchop solves, optimization and ephemeris over HTTP.")
+        parser.add_argument("--host", default="127.0.0.1", help="interface to listen on (default: 127.0.0.1)")
+        parser.add_argument("-p", "--port", type=int, default=8765, help="port to listen on (default: 8765)")
+        parser.add_argument("-w", "--workers", type=int, default=cls.workers,
+                            help="solver processes (default: MISSION_PLANNER_SERVICE_WORKERS or all cores)")
+        parser.add_argument("--max-pending", type=int, default=cls.max_pending,
+                            help="distinct jobs queued or running before requests are refused (default: 64)")
+        args = parser.parse_args(argv)
+
+        cls.workers, cls.max_pending = args.workers, args.max_pending
+        server = ThreadingHTTPServer((args.host, args.port), cls.Handler)
+        print("Serving on http://%s:%d with %d workers" % (args.host, args.port, cls.workers))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            if cls._pool is not None:
+                cls._pool.shutdown()
+
+
+if __name__ == "__main__":
+    Service.main()
@@ -1,23 +1,124 @@
-import plotly.graph_objects as go
-import streamlit as st
-import jdcal as jd
 import numpy as np
+import threading
 import datetime
+import time
+import os
 
-from astropy import units as u
-from poliastro.iod.vallado import lambert
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from multiprocessing import shared_memory
+
+from scipy.optimize import minimize
+
+try:
+    import plotly.graph_objects as go
+    import streamlit as st
+except ImportError: # the app's plotting stack is optional, everything but Tools.Plot runs without it
+    go = st = None
+
+try:
+    from astropy import units as u
+    from poliastro.iod.vallado import lambert
+except ImportError: # poliastro is optional, it is only the scalar reference solver, see solveLambert
+    u = lambert = None
+
+from Cache import Cache
+from Planet import Ephemeris
+from Diagnostics import Diagnostics
+from Lambert import Lambert
 
 
 class Tools:
     
     class Transfer:
+        # Grids smaller than this are solved in-process, the pool start-up is not worth it:
+        parallel_min_cells = 50000
+        tiles_per_worker = 4
+
+        # Processes of the pool shared by every solve, MISSION_PLANNER_WORKERS or all cores:
+        pool_size = int(os.environ.get("MISSION_PLANNER_WORKERS", 0)) or os.cpu_count() or 1
+
+        _pool = None
+        _pool_lock = threading.Lock()
+
+        # Number of recently used grids searched for cells to reuse when extending a grid:
+        overlap_candidates = 16
+
+        # Approximate number of cells solved between two partial results of stream:
+        stream_cells = 20000
+
+        # Lambert solver behind lambertBatch: "numba" (the compiled kernel in Lambert.py), "numpy"
+        # (vectorized below), or "auto" for numba whenever it is installed:
+        engine = os.environ.get("MISSION_PLANNER_ENGINE", "auto")
+
+        class Result:
+            # A solved porkchop grid. The six metrics are held in one float32 (6, num_arrivals,
+            # num_departures) array in solveBatch order, NaN where the solver failed, alongside an
+            # explicit validity mask per transfer type. Times of flight are derived from the dates on
+            # demand instead of being stored. Pickling (protocol 5) hands the arrays over as
+            # out-of-band buffers, and arrays() / fromArrays() map it onto flat storage.
+
+            ## Variables:
+            # jdd, jad = julian dates of departure, arrival
+            # metrics  = c3s0, c3l0, vinfs1, vinfl1, dVs, dVl stacked as float32
+            # valid    = (2, num_arrivals, num_departures) bool, cells with a type 1, type 2 solution
+            # revs     = int8 revolution count each metric's value came from, None unless the grid
+            #            was solved with max_revs > 0
+            # skipped  = number of cells never sent to the solver, see prune
+            # solved   = (num_arrivals, num_departures) bool, cells that were sent to the solver, None
+            #            for grids cached before it was recorded, which had every cell solved
+
+            __slots__ = ("jdd", "jad", "metrics", "valid", "revs", "skipped", "solved")
+
+            names = ("c3s0", "c3l0", "vinfs1", "vinfl1", "dVs", "dVl")
+
+            def __init__(self, jdd, jad, metrics, valid=None, revs=None, skipped=0, solved=None):
+                self.jdd = np.asarray(jdd, dtype=float)
+                self.jad = np.asarray(jad, dtype=float)
+                self.metrics = np.asarray(metrics, dtype=np.float32)
+                self.valid = np.isfinite(self.metrics[:2]) if valid is None else np.asarray(valid, dtype=bool)
+                self.revs = None if revs is None else np.asarray(revs, dtype=np.int8)
+                self.solved = None if solved is None else np.asarray(solved, dtype=bool)
+                if self.solved is not None:
+                    skipped = self.solved.size - np.count_nonzero(self.solved)
+                self.skipped = 0 if skipped is None else int(skipped)
+
+            def __getstate__(self):
+                return {name: getattr(self, name) for name in self.__slots__}
+
+            def __setstate__(self, state):
+                for name, value in state.items():
+                    setattr(self, name, value)
+
+            def __getitem__(self, name):
+                return self.metrics[self.names.index(name)]
+
+            @property
+            def tofs(self):
+                return np.subtract.outer(self.jad, self.jdd) # [days]
+
+            def grids(self):
+                # The grids in the order Tools.Plot.porkchop takes them.
+                return tuple(self.metrics) + (self.tofs,)
+
+            def arrays(self):
+                return {name: value for name, value in self.__getstate__().items() if value is not None}
+
+            @classmethod
+            def fromArrays(cls, arrays):
+                return cls(**{name: arrays.get(name) for name in cls.__slots__})
+
         @classmethod
-        @st.cache
-        def solve(cls, k, Body0, Body1, jdd, jad):
-            # Solves lamberts problem for a range of dates and returns 2D arrays of the resultant 
-            # characteristic energy, arrival excess velocity, and velocity increment aka delta-V.
-            # Also returned are the departure and arrival body coodinates and velocities, as well 
-            # as an array of flight times.
+        def solve(cls, k, Body0, Body1, jdd, jad, workers=None, max_revs=0, bounds=None):
+            # Solves lamberts problem for a range of dates and returns a Result holding 2D arrays of the
+            # resultant characteristic energy, arrival excess velocity, and velocity increment aka
+            # delta-V, for both transfer types. Large grids are split across `workers` processes
+            # (default: all cores). Results are kept in the on-disk Cache, keyed by the
+            # gravitational parameter, body names and dates. When the dates overlap a grid solved
+            # earlier for the same bodies, only the new rows and columns are solved. With max_revs > 0
+            # transfers of up to max_revs full revolutions compete with the direct ones. Cells that
+            # cannot have a solution, or (given bounds) cannot come in under any contour upper bound,
+            # are skipped and left NaN, see prune. Grids remember which cells they solved, so other
+            # bounds later on only cost the cells they keep that earlier bounds skipped.
 
             ## Variables:
             # c3s0           = characteristic energy at departure, type 1 transfer (short path)
@@ -26,48 +127,544 @@ class Tools:
             # dVl            = velocity increment aka delta-V, type 2 transer, (long path)
             # jdd, jdd_grid  = list, matrix of julian dates for departure
             # jad, jad_grid  = list, matrix of julian dates for arrival
-            # num_departures = index for the number of departures
-            # num_arrivals   = index for the number of arrivals    
             # rP0, vP0       = array of positions, velocities of departure body for given date range
             # rP1, vP1       = array of positions, velocities of arrival body for given date range
             # tofs           = arrival of times of flight
             # vinfs1         = excess velocity at arrival, type 1 transfer (short path)
             # vinfl1         = excess velocity at departure, type 2 transfer (long path)        
+            # workers        = number of worker processes, None for all cores
+            # max_revs       = largest number of full revolutions considered
+            # bounds         = contour upper bounds by metric, ie: {"c3": 40, "vinf": 15, "dv": 20}
+            # pair, key      = disk cache namespace of this body pair, key of this grid within it
+            # solved         = cells solved so far, reused from cached grids or solved here
+            # missing        = cells sent to the solver: kept by prune and not solved before
 
-            # Initialize indexes:
-            num_departures = len(jdd)
-            num_arrivals = len(jad)
-
-            # Initialize Data Arrays:
-            c3s0 = np.zeros((num_arrivals, num_departures))
-            c3l0 = np.zeros((num_arrivals, num_departures))
-            vinfs1 = np.zeros((num_arrivals, num_departures))
-            vinfl1 = np.zeros((num_arrivals, num_departures))
-            dVs = np.zeros((num_arrivals, num_departures))
-            dVl = np.zeros((num_arrivals, num_departures))
+            # Start from the cells already solved on these dates, or on overlapping ones:
+            pair = cls.namespace(k, Body0, Body1, max_revs)
+            key = Cache.key(jdd, jad)
+            out, solved, exact = cls.seed(pair, key, jdd, jad, max_revs)
 
             # Initialize and populate time of flight:
             jdd_grid, jad_grid = np.meshgrid(jdd, jad)
             tofs = jad_grid - jdd_grid
 
+            # A cached grid that had every cell with a positive flight time solved is served as is:
+            if exact and not np.any((tofs > 0) & ~solved):
+                return cls.Result(jdd, jad, out[:6], revs=out[6:] if max_revs else None, solved=solved)
+
             # Get departure and arrival body coordinates:
-            rP0, vP0 = Body0.getCoords(jdd) # [km, km/s]
-            rP1, vP1 = Body1.getCoords(jad) # [km, km/s]
-            rP0 = rP0.transpose()
-            rP1 = rP1.transpose()
-            vP0 = vP0.transpose()
-            vP1 = vP1.transpose()   
+            rP0, vP0 = Body0.getStates(jdd) # [km, km/s]
+            rP1, vP1 = Body1.getStates(jad) # [km, km/s]
 
-            # Populate data arrrays with lambert solutions:
-            for ai in range(num_arrivals): # For each arrival date and
-                for di in range(num_departures): # for each departure date, solve lamberts problem:
-                    (c3s0[ai, di], c3l0[ai, di], vinfs1[ai, di],
-                     vinfl1[ai, di], dVs[ai, di], dVl[ai, di]) = cls.solveLambert(k, rP0[di], rP1[ai], vP0[di], vP1[ai], tofs[ai][di] * 86400)
+            # Populate data arrays with lambert solutions, for the cells worth solving not solved yet:
+            missing = cls.prune(k, rP0, rP1, vP0, vP1, tofs, bounds) & ~solved
+            if missing.any():
+                out[:, missing] = cls.solveGrid(k, rP0, rP1, vP0, vP1, tofs, workers, max_revs, missing)[:, missing]
+                solved |= missing
+            result = cls.Result(jdd, jad, out[:6], revs=out[6:] if max_revs else None, solved=solved)
+            if missing.any() or not exact:
+                Cache.save(pair, key, **result.arrays())
 
-            return rP0, vP0, rP1, vP1, c3s0, c3l0, vinfs1, vinfl1, dVs, dVl, tofs
+            return result
+
+        @classmethod
+        def stream(cls, k, Body0, Body1, jdd, jad, workers=None, max_revs=0, bounds=None):
+            # Generator variant of solve. Yields (result, done, total) every time a block of arrival
+            # rows finishes, where result is a Result of the whole grid with the cells still unsolved
+            # set to NaN, and done, total count solved and overall cells. The last item yielded is the
+            # complete grid, which is cached exactly like solve would. Cached grids and cells reused
+            # from overlapping grids arrive in the first item. Closing the generator early (or
+            # abandoning it) cancels every block not yet started. Cells skipped by prune, or reused
+            # from the cache, count as solved. Every item but the last is a view of the grid still
+            # being filled in, so it keeps changing as later blocks arrive; copy its arrays to keep a
+            # snapshot.
+
+            ## Variables:
+            # out          = (6 or 12, num_arrivals, num_departures) grid being filled in
+            # solved       = cells solved once the stream is through, see solve
+            # missing      = cells sent to the solver, see solve
+            # blocks       = (arrival rows, departure columns) index pairs still to be solved
+            # stream_cells = approximate cells per block
+
+            pair = cls.namespace(k, Body0, Body1, max_revs)
+            key = Cache.key(jdd, jad)
+            out, solved, exact = cls.seed(pair, key, jdd, jad, max_revs)
+            tofs = np.subtract.outer(np.asarray(jad, dtype=float), np.asarray(jdd, dtype=float))
+            if exact and not np.any((tofs > 0) & ~solved):
+                result = cls.Result(jdd, jad, out[:6], revs=out[6:] if max_revs else None, solved=solved)
+                yield result, tofs.size, tofs.size
+                return
+
+            rP0, vP0 = Body0.getStates(jdd) # [km, km/s]
+            rP1, vP1 = Body1.getStates(jad) # [km, km/s]
+            missing = cls.prune(k, rP0, rP1, vP0, vP1, tofs, bounds) & ~solved
+            solved = solved | missing # once the stream is through
+
+            # Queue up the arrival rows holding cells to solve, in blocks of about stream_cells of them:
+            rows = np.flatnonzero(missing.any(axis=1))
+            width = np.count_nonzero(missing) // max(rows.size, 1)
+            blocks = [(tile, np.arange(len(jdd))) for tile in cls.blocks(rows, width)]
+
+            def partial():
+                return cls.Result(jdd, jad, out[:6], revs=out[6:] if max_revs else None, solved=solved)
+
+            total, done = tofs.size, tofs.size - np.count_nonzero(missing)
+            yield partial(), done, total
+
+            def arguments(rows, cols):
+                cells = (rows[:, np.newaxis], cols)
+                return k, rP0[cols], rP1[rows], vP0[cols], vP1[rows], tofs[cells], 1, max_revs, missing[cells]
+
+            workers = workers or os.cpu_count() or 1
+            parallel = workers > 1 and total >= cls.parallel_min_cells
+            if parallel:
+                finished = cls.collect(cls.farm(((block, cls.solveGrid) + arguments(*block) for block in blocks), workers))
+            else:
+                finished = ((block, cls.solveGrid(*arguments(*block))) for block in blocks)
+            try:
+                for (rows, cols), grid in finished:
+                    cells = (rows[:, np.newaxis], cols)
+                    if parallel:
+                        cls.tally(grid, missing[cells]) # solved in another process
+                    out[:, cells[0], cells[1]] = np.where(missing[cells], grid, out[:, cells[0], cells[1]])
+                    done += np.count_nonzero(missing[cells])
+                    if done < total:
+                        yield partial(), done, total
+            finally:
+                finished.close()
+
+            result = cls.Result(jdd, jad, out[:6].copy() if max_revs else out, revs=out[6:] if max_revs else None,
+                                solved=solved)
+            Cache.save(pair, key, **result.arrays())
+            yield result, total, total
+
+        @staticmethod
+        def collect(finished):
+            # Passes on the (block, grid) pairs of a farm. The solves themselves run in the workers,
+            # which record nothing, so the time spent waiting on the pool is recorded here as one
+            # solve.lambert call, leaving out the time the caller spends between blocks.
+
+            waited = 0.0
+            try:
+                while True:
+                    start = time.perf_counter()
+                    item = next(finished, None)
+                    waited += time.perf_counter() - start
+                    if item is None:
+                        break
+                    yield item
+            finally:
+                finished.close()
+                Diagnostics.record("solve.lambert", waited)
+
+        @classmethod
+        def blocks(cls, rows, width):
+            # Splits arrival rows into contiguous blocks of about stream_cells cells each.
+
+            if not rows.size or not width:
+                return []
+            return np.array_split(rows, max(1, min(rows.size, rows.size * width // cls.stream_cells)))
+
+        @classmethod
+        def refine(cls, k, Body0, Body1, jdd, jad, bounds, stride=8, margin=0.25, workers=None, max_revs=0):
+            # Coarse-to-fine variant of solve. Solves every stride-th date of jdd, jad first, then only
+            # solves the fine cells around coarse cells where some metric came in under its contour
+            # upper bound (plus margin). Everything else is left NaN, which is harmless since it lies
+            # above every displayed contour. Returns a Result on the fine dates, like solve.
+
+            ## Variables:
+            # bounds       = contour upper bounds by metric, ie: {"c3": 40, "vinf": 15, "dv": 20}
+            # stride       = number of fine dates per coarse step
+            # margin       = fractional allowance above the bounds when selecting coarse cells
+            # di_c, ai_c   = indexes of the coarse dates within jdd, jad
+            # near         = coarse nodes within one coarse step of an interesting node
+            # selected     = fine cells to solve
+
+            pair = cls.namespace(k, Body0, Body1, max_revs, kind="refine")
+            key = Cache.key(jdd, jad, sorted(bounds.items()), stride, margin)
+            cached = Cache.load(pair, key)
+            if cached is not None:
+                return cls.Result.fromArrays(cached)
+
+            jdd = np.asarray(jdd, dtype=float)
+            jad = np.asarray(jad, dtype=float)
+
+            # Coarse pass, always including the last date so the coarse grid spans the fine one:
+            di_c = np.unique(np.r_[np.arange(0, len(jdd), stride), len(jdd) - 1])
+            ai_c = np.unique(np.r_[np.arange(0, len(jad), stride), len(jad) - 1])
+            coarse = cls.solve(k, Body0, Body1, jdd[di_c], jad[ai_c], workers, max_revs).metrics
+
+            # Flag coarse nodes under the bounds and grow the flags by one coarse step:
+            near = np.pad(cls.withinBounds(coarse, bounds, margin), 1)
+            near = np.max([near[1 + i:near.shape[0] - 1 + i, 1 + j:near.shape[1] - 1 + j]
+                           for i in (-1, 0, 1) for j in (-1, 0, 1)], axis=0)
+
+            # A fine cell is solved if any corner of the coarse cell containing it is flagged:
+            d_lo = np.searchsorted(di_c, np.arange(len(jdd)), "right") - 1
+            d_hi = np.searchsorted(di_c, np.arange(len(jdd)), "left")
+            a_lo = np.searchsorted(ai_c, np.arange(len(jad)), "right") - 1
+            a_hi = np.searchsorted(ai_c, np.arange(len(jad)), "left")
+            selected = (near[a_lo[:, np.newaxis], d_lo] | near[a_lo[:, np.newaxis], d_hi] |
+                        near[a_hi[:, np.newaxis], d_lo] | near[a_hi[:, np.newaxis], d_hi])
+
+            # Fine pass over the selected cells only:
+            jdd_grid, jad_grid = np.meshgrid(jdd, jad)
+            tofs = jad_grid - jdd_grid
+
+            rP0, vP0 = Body0.getStates(jdd) # [km, km/s]
+            rP1, vP1 = Body1.getStates(jad) # [km, km/s]
+
+            selected &= cls.prune(k, rP0, rP1, vP0, vP1, tofs, bounds, margin)
+            grid = cls.solveGrid(k, rP0, rP1, vP0, vP1, tofs, workers, max_revs, selected)
+
+            result = cls.Result(jdd, jad, grid[:6].copy() if max_revs else grid, revs=grid[6:] if max_revs else None,
+                                solved=selected)
+            Cache.save(pair, key, **result.arrays())
+
+            return result
+
+        @staticmethod
+        def namespace(k, Body0, Body1, max_revs=0, kind="grids"):
+            # Disk cache namespace of the grids of a body pair. Every ephemeris kernel has its own, see
+            # Ephemeris.identity. Bounds are not part of it: grids record which cells they solved.
+
+            parts = (k, Body0.properties["name"], Body1.properties["name"], max_revs, Ephemeris.identity())
+            return os.path.join(kind, Cache.key(*parts))
+
+        @classmethod
+        def prune(cls, k, rP0, rP1, vP0, vP1, tofs, bounds=None, margin=0.25):
+            # Pre-pass over a grid, returns a boolean (num_arrivals, num_departures) mask of the cells
+            # worth solving. Non-positive times of flight never are. Given bounds, neither are cells
+            # whose lower bounds on every bounded metric exceed the upper bound times (1 + margin),
+            # the margin keeping the cells just past a contour so it can still be drawn. The bounds
+            # hold for every transfer type and revolution count, so a skipped cell is one that could
+            # only ever have been plotted above every contour:
+            # - the transfer orbit has energy of at least -k / s, the minimum energy ellipse through
+            #   both positions, and at least 0 when the flight is faster than the parabolic one,
+            #   which bounds the transfer speed at either end from below;
+            # - the transfer velocity lies in the plane of both positions, so the planet's velocity
+            #   out of that plane has to be made up entirely by the excess velocity.
+
+            ## Variables:
+            # s, c        = semi-perimeter and chord of the transfer triangle
+            # t_p         = parabolic flight time of the short way, the fastest elliptic transfer
+            # n           = unit normal of the transfer plane, 0 where the positions are collinear
+            # c3, vinf    = lower bounds of the departure C3, arrival V infinity
+
+            with Diagnostics.stage("solve.prune"):
+                keep = tofs > 0
+                if bounds:
+                    r0 = np.linalg.norm(rP0, axis=-1)
+                    r1 = np.linalg.norm(rP1, axis=-1)[:, np.newaxis]
+                    c = np.linalg.norm(rP1[:, np.newaxis] - rP0, axis=-1)
+                    s = (r0 + r1 + c) / 2
+                    t_p = np.sqrt(2) / 3 * np.sqrt(s**3 / k) * (1 - ((s - c) / s)**1.5) / 86400 # [days]
+                    energy = np.where(tofs < t_p, 0, -k / s)
+
+                    n = np.cross(rP0, rP1[:, np.newaxis])
+                    area = np.linalg.norm(n, axis=-1, keepdims=True)
+                    n = np.where(area > 1e-9 * r0[:, np.newaxis] * r1[..., np.newaxis], n / np.maximum(area, 1e-300), 0)
+
+                    def excess(vP, r, n):
+                        out = np.abs(np.sum(vP * n, axis=-1))
+                        inplane = np.sqrt(np.maximum(np.sum(vP**2, axis=-1) - out**2, 0))
+                        return np.hypot(np.maximum(np.sqrt(2 * (energy + k / r)) - inplane, 0), out)
+
+                    c3 = excess(vP0, r0, n)**2
+                    vinf = excess(vP1[:, np.newaxis], r1, n)
+                    lower = np.stack((c3, c3, vinf, vinf, np.sqrt(c3) + vinf, np.sqrt(c3) + vinf))
+                    keep &= cls.withinBounds(lower, bounds, margin)
+
+            Diagnostics.count("solve.skipped", keep.size - np.count_nonzero(keep))
+            return keep
+
+        @staticmethod
+        def withinBounds(metrics, bounds, margin=0.0):
+            # Takes a (6, ...) array of metrics in solveBatch order and returns a boolean mask of the
+            # cells where any metric named in bounds is below its upper bound times (1 + margin).
+            # NaN cells are never within bounds.
+
+            rows = {"c3": (0, 1), "vinf": (2, 3), "dv": (4, 5)}
+            mask = np.zeros(metrics.shape[1:], dtype=bool)
+            with np.errstate(invalid="ignore"):
+                for metric, bound in bounds.items():
+                    for row in rows[metric]:
+                        mask |= metrics[row] <= bound * (1 + margin)
+            return mask
+
+        @classmethod
+        def optimize(cls, k, Body0, Body1, jdd, jad, metric="dv", coarse_inc=10, seeds=3, xtol=1e-3, ftol=1e-6,
+                     workers=None):
+            # Finds the departure/arrival pair minimizing metric ("c3", "vinf" or "dv") without
+            # rendering a full grid. A coarse grid from solve provides seeds, the best few local
+            # minima of each transfer type, which are then polished by a bounded Nelder-Mead search
+            # over (departure date, time of flight) on the Lambert solution of that type.
+
+            ## Variables:
+            # jdd, jad     = (earliest, latest) julian dates of departure, arrival
+            # coarse_inc   = date increment of the seeding grid [days]
+            # seeds        = number of coarse minima polished per transfer type
+            # xtol, ftol   = absolute tolerances on the dates [days] and on metric
+            # evaluations  = lambert solves spent on the local searches
+            # workers      = worker processes of the seeding grid, None for all cores
+
+            rows = {"c3": (0, 1), "vinf": (2, 3), "dv": (4, 5)}[metric]
+
+            # Seed from a coarse grid:
+            jdd_c = np.unique(np.r_[np.arange(jdd[0], jdd[1], coarse_inc), jdd[1]])
+            jad_c = np.unique(np.r_[np.arange(jad[0], jad[1], coarse_inc), jad[1]])
+            coarse = cls.solve(k, Body0, Body1, jdd_c, jad_c, workers).metrics
+
+            bounds = [(jdd[0], jdd[1]), (max(jad[0] - jdd[1], 1e-3), jad[1] - jdd[0])]
+            evaluations = [0]
+            best = None
+
+            for transfer, row in enumerate(rows):
+                grid = np.where(np.isfinite(coarse[row]), coarse[row], np.inf)
+                padded = np.pad(grid, 1, constant_values=np.inf)
+                neighbours = np.min([padded[1 + i:padded.shape[0] - 1 + i, 1 + j:padded.shape[1] - 1 + j]
+                                     for i in (-1, 0, 1) for j in (-1, 0, 1) if i or j], axis=0)
+                minima = np.flatnonzero((grid <= neighbours) & np.isfinite(grid))
+                minima = minima[np.argsort(grid.ravel()[minima])][:seeds]
+
+                def objective(x, short=(transfer == 0), row=row):
+                    evaluations[0] += 1
+                    arrival = x[0] + x[1]
+                    penalty = max(jad[0] - arrival, arrival - jad[1], 0.0)
+                    value = cls.evaluate(k, Body0, Body1, x[0], x[1], short)[row // 2]
+                    return (value if np.isfinite(value) else 1e10) + 1e3 * penalty
+
+                for cell in minima:
+                    ai, di = np.unravel_index(cell, grid.shape)
+                    x0 = (jdd_c[di], jad_c[ai] - jdd_c[di])
+                    res = minimize(objective, x0, method="Nelder-Mead", bounds=bounds,
+                                   options={"xatol": xtol, "fatol": ftol, "maxfev": 400})
+                    if res.fun < 1e10 and (best is None or res.fun < best[0]):
+                        best = (res.fun, transfer, res)
+
+            if best is None:
+                return None
+
+            _, transfer, res = best
+            jd_departure, tof = res.x
+            c3, vinf, dv = cls.evaluate(k, Body0, Body1, jd_departure, tof, transfer == 0)
+
+            return {
+                "metric": metric,
+                "type": transfer + 1,
+                "jd_departure": float(jd_departure),
+                "jd_arrival": float(jd_departure + tof),
+                "tof": float(tof),
+                "c3": float(c3),
+                "vinf": float(vinf),
+                "dv": float(dv),
+                "converged": bool(res.success),
+                "xtol": xtol,
+                "ftol": ftol,
+                "grid_evaluations": 2 * coarse[0].size,
+                "evaluations": evaluations[0],
+            }
+
+        @classmethod
+        def evaluate(cls, k, Body0, Body1, jd_departure, tof, short=True):
+            # Solves a single transfer departing at jd_departure with a flight time of tof days and
+            # returns its (c3, vinf, dv), NaN if there is no solution.
+
+            rP0, vP0 = Body0.getCoords([jd_departure]) # [km, km/s]
+            rP1, vP1 = Body1.getCoords([jd_departure + tof]) # [km, km/s]
+            v0, v1 = cls.lambertBatch(k, rP0.T, rP1.T, [tof * 86400], short)
+
+            c3 = np.sum((v0 - vP0.T)**2)
+            vinf = np.linalg.norm(v1 - vP1.T)
+            return c3, vinf, vinf + np.sqrt(c3)
+
+        @classmethod
+        def solveGrid(cls, k, rP0, rP1, vP0, vP1, tofs, workers=None, max_revs=0, keep=None):
+            # Solves every (arrival, departure) cell of a grid and returns a float32 (6, num_arrivals,
+            # num_departures) array of metrics in solveBatch order (12 rows with max_revs > 0, the last
+            # six holding revolution counts). The arrival axis is cut into
+            # row tiles which are farmed out to a process pool; each worker writes its tile straight
+            # into a shared memory block, so only the small state arrays are ever pickled. Given a
+            # boolean keep mask, only those cells are solved and the rest are left NaN.
+
+            ## Variables:
+            # workers = number of worker processes, None for all cores
+            # tiles   = arrival index ranges, one per task
+            # shm     = shared memory block backing the output grids
+
+            workers = workers or os.cpu_count() or 1
+            shape = (12 if max_revs else 6,) + tofs.shape
+
+            with Diagnostics.stage("solve.lambert"):
+                if workers == 1 or tofs.size < cls.parallel_min_cells:
+                    out = np.empty(shape, dtype=np.float32)
+                    cls.solveTile(None, shape, k, rP0, rP1, vP0, vP1, tofs, 0, out, max_revs, keep)
+                else:
+                    tiles = np.array_split(np.arange(tofs.shape[0]), min(tofs.shape[0], workers * cls.tiles_per_worker))
+                    shm = shared_memory.SharedMemory(create=True, size=int(np.prod(shape)) * np.dtype(np.float32).itemsize)
+                    try:
+                        for _ in cls.farm(((rows, cls.solveTile, shm.name, shape, k, rP0, rP1[rows], vP0, vP1[rows],
+                                            tofs[rows], rows[0], None, max_revs, None if keep is None else keep[rows])
+                                           for rows in tiles if rows.size), workers):
+                            pass
+                        out = np.array(np.ndarray(shape, dtype=np.float32, buffer=shm.buf))
+                    finally:
+                        shm.close()
+                        shm.unlink()
+
+            cls.tally(out, keep)
+            return out
+
+        @staticmethod
+        def tally(grid, keep=None):
+            # Counts the direct lambert solves behind a grid of metrics, and those that failed, in
+            # Diagnostics.
+
+            calls = 2 * (grid[0].size if keep is None else np.count_nonzero(keep))
+            Diagnostics.count("lambert.calls", calls)
+            Diagnostics.count("lambert.failed", calls - np.count_nonzero(np.isfinite(grid[:2])))
+
+        @classmethod
+        def seed(cls, namespace, key, jdd, jad, max_revs=0):
+            # Starts a grid on the dates jdd, jad from the grids cached under namespace: the one on
+            # exactly these dates (key) if there is one, else the one sharing the most cells with
+            # them. Returns the float32 (6 or 12, num_arrivals, num_departures) grid with the cells
+            # reused from it filled in and the rest NaN, the mask of the reused cells that had been
+            # solved, and whether the grid came from an exact match. Panning a window therefore
+            # costs a strip, not a full grid.
+
+            ## Variables:
+            # d_new, d_old = indexes of the shared departure dates in jdd, in the cached grid
+            # a_new, a_old = indexes of the shared arrival dates in jad, in the cached grid
+
+            out = np.full((12 if max_revs else 6, len(jad), len(jdd)), np.nan, dtype=np.float32)
+            out[6:] = 0
+            solved = np.zeros(out.shape[1:], dtype=bool)
+
+            cached = Cache.load(namespace, key)
+            exact = cached is not None
+            if exact:
+                (d_new, d_old), (a_new, a_old) = [(np.arange(len(dates)),) * 2 for dates in (jdd, jad)]
+            else:
+                cached, (d_new, d_old), (a_new, a_old) = cls.findOverlap(namespace, jdd, jad)
+                if cached is None:
+                    return out, solved, False
+
+            new, old = (a_new[:, np.newaxis], d_new), (a_old[:, np.newaxis], d_old)
+            out[:6, new[0], new[1]] = cached["metrics"][:, old[0], old[1]]
+            if max_revs and "revs" in cached:
+                out[6:, new[0], new[1]] = cached["revs"][:, old[0], old[1]]
+            solved[new] = cached["solved"][old] if "solved" in cached else True
+            return out, solved, exact
+
+        @classmethod
+        def findOverlap(cls, namespace, jdd, jad):
+            # Searches the most recently used grids cached under namespace for the one sharing the most
+            # (arrival, departure) cells with the requested dates. Dates are matched exactly (to a
+            # microday), so only grids on the same date lattice can contribute. Returns the cached
+            # arrays and the matching index pairs, or None and empty indexes.
+
+            jdd = np.round(np.asarray(jdd, dtype=float), 6)
+            jad = np.round(np.asarray(jad, dtype=float), 6)
+            none = np.empty(0, dtype=int)
+
+            with Diagnostics.stage("solve.overlap"):
+                best, best_cells = None, 0
+                for key in Cache.keys(namespace)[:cls.overlap_candidates]:
+                    dates = Cache.load(namespace, key, ("jdd", "jad"), touch=False)
+                    if dates is None:
+                        continue
+                    _, d_new, d_old = np.intersect1d(jdd, np.round(dates["jdd"], 6), return_indices=True)
+                    _, a_new, a_old = np.intersect1d(jad, np.round(dates["jad"], 6), return_indices=True)
+                    if d_new.size * a_new.size > best_cells:
+                        best, best_cells = (key, (d_new, d_old), (a_new, a_old)), d_new.size * a_new.size
+
+            if best is None:
+                return None, (none, none), (none, none)
+
+            key, departures, arrivals = best
+            cached = Cache.load(namespace, key)
+            if cached is None:
+                return None, (none, none), (none, none)
+
+            return cached, departures, arrivals
+
+        @classmethod
+        def solveTile(cls, name, shape, k, rP0, rP1, vP0, vP1, tofs, row0, out=None, max_revs=0, keep=None):
+            # Worker task for solveGrid: solves the arrival rows [row0, row0 + len(rP1)) against every
+            # departure (or only the cells in keep) and writes them into the output grids, either
+            # `out` directly or the shared memory block called `name`.
+
+            cells = tofs.shape
+            if keep is None:
+                metrics = cls.solveBatch(
+                    k,
+                    np.broadcast_to(rP0, cells + (3,)).reshape(-1, 3),
+                    np.broadcast_to(rP1[:, np.newaxis], cells + (3,)).reshape(-1, 3),
+                    np.broadcast_to(vP0, cells + (3,)).reshape(-1, 3),
+                    np.broadcast_to(vP1[:, np.newaxis], cells + (3,)).reshape(-1, 3),
+                    np.ravel(tofs) * 86400,
+                    max_revs)
+            else:
+                ai, di = np.nonzero(keep)
+                solved = cls.solveBatch(k, rP0[di], rP1[ai], vP0[di], vP1[ai], tofs[ai, di] * 86400, max_revs)
+                metrics = np.zeros((len(solved),) + cells)
+                metrics[:6] = np.nan
+                metrics[:, ai, di] = solved
+
+            shm = None if out is not None else shared_memory.SharedMemory(name=name)
+            try:
+                if shm is not None:
+                    out = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+                for i, metric in enumerate(metrics):
+                    out[i, row0:row0 + cells[0]] = metric.reshape(cells)
+            finally:
+                if shm is not None:
+                    del out
+                    shm.close()
+
+        @classmethod
+        def getPool(cls):
+            # Process pools are expensive to start, and forking a new one while other sessions'
+            # threads are busy can hand its workers a lock that is never released. So a single pool
+            # of pool_size processes is started on first use and shared by every caller for the life
+            # of the process, each caller keeping no more than its own worker count busy, see farm.
+
+            with cls._pool_lock:
+                if cls._pool is None:
+                    cls._pool = ProcessPoolExecutor(max_workers=cls.pool_size)
+                return cls._pool
+
+        @classmethod
+        def farm(cls, tasks, workers):
+            # Runs tasks, (tag, function, *arguments) tuples, on the shared pool with at most
+            # workers of them submitted at once, and yields (tag, result) as they finish. Tasks are
+            # only built as they are submitted. Closing the generator cancels the tasks not started.
+
+            pool = cls.getPool()
+            tasks = iter(tasks)
+            running = {}
+            try:
+                while True:
+                    while len(running) < workers:
+                        task = next(tasks, None)
+                        if task is None:
+                            break
+                        running[pool.submit(*task[1:])] = task[0]
+                    if not running:
+                        return
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        yield running.pop(future), future.result()
+            finally:
+                for future in running:
+                    future.cancel()
 
         @classmethod
         def solveLambert(cls, k, rP0, rP1, vP0, vP1, tof):
+            if lambert is None:
+                raise ImportError("solveLambert needs poliastro, see requirements.txt")
+
             try: # Short path calculations
                 (vs0, vs1), = lambert(k * u.km**3 / u.s**2, rP0 * u.km, rP1 * u.km, tof * u.s, True)
                 vs0 = vs0.value # strip units
@@ -94,14 +691,436 @@ class Tools:
                 vinfl1 = None
                 dVl = None
             return c3s0, c3l0, vinfs1, vinfl1, dVs, dVl
+
+        @classmethod
+        def solveBatch(cls, k, rP0, rP1, vP0, vP1, tofs, max_revs=0):
+            # Vectorized counterpart of solveLambert. Takes flat arrays of departure/arrival states, one
+            # row per transfer, and returns the same six metrics as 1D arrays. Units are stripped at the
+            # boundary, everything in between is plain float64 [km, km/s, s]. Cells for which the
+            # solver fails to converge are returned as NaN.
+            # With max_revs > 0, transfers making up to max_revs full revolutions are considered too:
+            # each metric then holds the best value over all revolution counts and both branches, and
+            # six more arrays follow with the revolution count each best value came from.
+
+            ## Variables:
+            # rP0, vP0 = (N, 3) arrays of departure body positions, velocities [km, km/s]
+            # rP1, vP1 = (N, 3) arrays of arrival body positions, velocities [km, km/s]
+            # tofs     = (N,) array of flight times [s]
+            # max_revs = largest number of full revolutions to consider
+            # vs0, vs1 = departure, arrival velocities, type 1 transfer (short path)
+            # vl0, vl1 = departure, arrival velocities, type 2 transfer (long path)
+
+            vs0, vs1 = cls.lambertBatch(k, rP0, rP1, tofs, True)
+            vl0, vl1 = cls.lambertBatch(k, rP0, rP1, tofs, False)
+
+            c3s0 = np.sum((vs0 - vP0)**2, axis=-1) # Short path departure excess energy
+            c3l0 = np.sum((vl0 - vP0)**2, axis=-1) # Long path departure excess energy
+            vinfs1 = np.linalg.norm(vs1 - vP1, axis=-1) # Short path arrival surplus velocity
+            vinfl1 = np.linalg.norm(vl1 - vP1, axis=-1) # Long path arrival surplus velocity
+            dVs = vinfs1 + np.sqrt(c3s0) # Short path total delta V requirement
+            dVl = vinfl1 + np.sqrt(c3l0) # Long path total delta V requirement
+
+            if not max_revs:
+                return c3s0, c3l0, vinfs1, vinfl1, dVs, dVl
+
+            # Keep the best of every feasible multi-revolution solution, per metric:
+            metrics = np.stack((c3s0, c3l0, vinfs1, vinfl1, dVs, dVl))
+            revs = np.zeros(metrics.shape)
+            feasible = cls.maxRevs(k, rP0, rP1, tofs, max_revs)
+            for m in range(1, max_revs + 1):
+                cells = np.flatnonzero(feasible >= m)
+                if not cells.size:
+                    break
+                for row, short in enumerate((True, False)):
+                    for v0, v1 in cls.lambertRevs(k, rP0[cells], rP1[cells], tofs[cells], m, short):
+                        c3 = np.sum((v0 - vP0[cells])**2, axis=-1)
+                        vinf = np.linalg.norm(v1 - vP1[cells], axis=-1)
+                        for i, value in zip((row, row + 2, row + 4), (c3, vinf, vinf + np.sqrt(c3))):
+                            better = value < np.where(np.isnan(metrics[i, cells]), np.inf, metrics[i, cells])
+                            metrics[i, cells[better]] = value[better]
+                            revs[i, cells[better]] = m
+
+            return tuple(metrics) + tuple(revs)
+
+        @staticmethod
+        def maxRevs(k, r0, r1, tof, max_revs):
+            # Upper bound on the number of full revolutions that fit in each transfer's flight time.
+            # Any conic through r0 and r1 has a semi-major axis of at least that of the minimum
+            # energy transfer, (|r0| + |r1| + chord) / 4, so no revolution can be faster than that
+            # orbit's period.
+
+            norm_r0 = np.sqrt(np.sum(np.asarray(r0)**2, axis=-1))
+            norm_r1 = np.sqrt(np.sum(np.asarray(r1)**2, axis=-1))
+            chord = np.sqrt(np.sum((np.asarray(r1) - r0)**2, axis=-1))
+            period = 2 * np.pi * np.sqrt(((norm_r0 + norm_r1 + chord) / 4)**3 / k)
+            with np.errstate(invalid="ignore"):
+                return np.clip(np.floor_divide(tof, period), 0, max_revs).astype(int)
+
+        @classmethod
+        def lambertRevs(cls, k, r0, r1, tof, revs, short=True, numiter=60):
+            # Multi-revolution Lambert solutions in Vallado's universal variable formulation. For revs
+            # full revolutions, psi lies in ((2 pi revs)^2, (2 pi (revs + 1))^2), where the time of flight
+            # is infinite at both ends and has a single minimum in between. The minimum is located by
+            # golden section search; cells whose flight time is below it have no solution, the others
+            # have one on each side of it, found by bisection. Returns the two (v0, v1) pairs, low psi
+            # branch first, with NaN rows where there is no solution.
+
+            ## Variables:
+            # r0, r1  = (N, 3) arrays of departure, arrival positions [km]
+            # tof     = (N,) array of flight times [s]
+            # revs    = number of full revolutions
+            # A       = geometry constant of the transfer, signed by transfer type
+            # psi_min = universal variable of the fastest revs-revolution transfer
+
+            r0 = np.asarray(r0, dtype=float)
+            r1 = np.asarray(r1, dtype=float)
+            tof = np.asarray(tof, dtype=float)
+
+            norm_r0 = np.sqrt(np.sum(r0**2, axis=-1))
+            norm_r1 = np.sqrt(np.sum(r1**2, axis=-1))
+            cos_dnu = np.sum(r0 * r1, axis=-1) / (norm_r0 * norm_r1)
+            A = (1 if short else -1) * np.sqrt(norm_r0 * norm_r1 * (1 + cos_dnu))
+
+            def flight(psi):
+                c2, c3 = cls.stumpff(psi)
+                y = norm_r0 + norm_r1 + A * (psi * c3 - 1) / np.sqrt(c2)
+                return y, (np.sqrt(y / c2)**3 * c3 + A * np.sqrt(y)) / np.sqrt(k)
+
+            lower = np.full_like(tof, (2 * np.pi * revs)**2 * (1 + 1e-12))
+            upper = np.full_like(tof, (2 * np.pi * (revs + 1))**2 * (1 - 1e-12))
+            ratio = (np.sqrt(5) - 1) / 2
+
+            with np.errstate(invalid="ignore", divide="ignore", over="ignore"):
+                # Golden section search for the minimum flight time:
+                a, b = lower.copy(), upper.copy()
+                for _ in range(numiter):
+                    c = b - ratio * (b - a)
+                    d = a + ratio * (b - a)
+                    left = flight(c)[1] < flight(d)[1]
+                    a, b = np.where(left, a, c), np.where(left, d, b)
+                psi_min = (a + b) / 2
+                feasible = (A != 0.0) & (tof >= flight(psi_min)[1])
+
+                # Bisection on each branch, flight time decreases left of psi_min and increases right:
+                solutions = []
+                for a, b, sign in ((lower, psi_min, 1), (psi_min, upper, -1)):
+                    for _ in range(numiter):
+                        psi = (a + b) / 2
+                        right = sign * (flight(psi)[1] - tof) > 0
+                        a, b = np.where(right, psi, a), np.where(right, b, psi)
+                    y, _ = flight((a + b) / 2)
+                    y = np.where(feasible, y, np.nan)
+
+                    f = (1 - y / norm_r0)[:, np.newaxis]
+                    g = (A * np.sqrt(y / k))[:, np.newaxis]
+                    gdot = (1 - y / norm_r1)[:, np.newaxis]
+                    solutions.append(((r1 - f * r0) / g, (gdot * r1 - r0) / g))
+
+            return solutions
+
+        @classmethod
+        def lambertBatch(cls, k, r0, r1, tof, short=True, numiter=35, rtol=1e-8):
+            # Vallado's universal variable algorithm (as implemented by poliastro.iod.vallado) applied
+            # to whole arrays of boundary conditions at once. Each iteration only touches the cells
+            # that have not yet converged. Returns the departure and arrival velocity vectors, with
+            # NaN rows wherever the scalar solver would have raised. Dispatches to the compiled kernel
+            # instead when the engine calls for it.
+
+            ## Variables:
+            # r0, r1       = (N, 3) arrays of departure, arrival positions [km]
+            # tof          = (N,) array of flight times [s]
+            # A            = geometry constant of the transfer, signed by transfer type
+            # psi          = universal variable, bracketed by psi_low and psi_up
+            # active       = cells still iterating
+            # converged    = cells with a valid solution
+
+            if cls.engine == "numba" or (cls.engine == "auto" and Lambert.available):
+                if not Lambert.available:
+                    raise ImportError("The numba Lambert engine needs numba installed")
+                return Lambert.solve(k, r0, r1, tof, short, numiter, rtol)
+            if cls.engine not in ("auto", "numpy"):
+                raise ValueError("Unknown Lambert engine %r, expected auto, numba or numpy" % cls.engine)
+
+            r0 = np.asarray(r0, dtype=float)
+            r1 = np.asarray(r1, dtype=float)
+            tof = np.asarray(tof, dtype=float)
+
+            norm_r0 = np.sqrt(np.sum(r0**2, axis=-1))
+            norm_r1 = np.sqrt(np.sum(r1**2, axis=-1))
+            norm_r0_times_norm_r1 = norm_r0 * norm_r1
+            norm_r0_plus_norm_r1 = norm_r0 + norm_r1
+            cos_dnu = np.sum(r0 * r1, axis=-1) / norm_r0_times_norm_r1
+            A = (1 if short else -1) * np.sqrt(norm_r0_times_norm_r1 * (1 + cos_dnu))
+
+            psi = np.zeros_like(tof)
+            psi_low = np.full_like(tof, -4 * np.pi**2)
+            psi_up = np.full_like(tof, 4 * np.pi**2)
+            y = np.zeros_like(tof)
+
+            # A phase angle of 180 degrees or a non-positive flight time has no solution:
+            active = (A != 0.0) & (tof > 0.0) & np.isfinite(A)
+            converged = np.zeros(tof.shape, dtype=bool)
+
+            with np.errstate(invalid="ignore", divide="ignore", over="ignore"):
+                for _ in range(numiter):
+                    idx = np.flatnonzero(active)
+                    if not idx.size:
+                        break
+
+                    a = A[idx]
+                    p = psi[idx]
+                    c2, c3 = cls.stumpff(p)
+                    yi = norm_r0_plus_norm_r1[idx] + a * (p * c3 - 1) / np.sqrt(c2)
+
+                    # Readjust psi_low until y > 0.0 (only for A > 0.0):
+                    adjust = (a > 0.0) & (yi < 0.0)
+                    for _ in range(numiter):
+                        if not adjust.any():
+                            break
+                        j = np.flatnonzero(adjust)
+                        psi_low[idx[j]] = p[j]
+                        p[j] = 0.8 * (1.0 / c3[j]) * (1.0 - norm_r0_times_norm_r1[idx[j]] * np.sqrt(c2[j]) / a[j])
+                        c2[j], c3[j] = cls.stumpff(p[j])
+                        yi[j] = norm_r0_plus_norm_r1[idx[j]] + a[j] * (p[j] * c3[j] - 1) / np.sqrt(c2[j])
+                        adjust[j] = yi[j] < 0.0
+                    active[idx[adjust]] = False # y could not be made positive, give up on these cells
+
+                    xi = np.sqrt(yi / c2)
+                    tof_new = (xi**3 * c3 + a * np.sqrt(yi)) / np.sqrt(k)
+                    psi[idx] = p
+                    y[idx] = yi
+
+                    # Convergence check:
+                    done = ~adjust & (np.abs((tof_new - tof[idx]) / tof[idx]) < rtol)
+                    converged[idx[done]] = True
+                    active[idx[done]] = False
+
+                    # Bisection step for the remaining cells:
+                    step = ~done & ~adjust
+                    condition = tof_new <= tof[idx]
+                    psi_low[idx] = np.where(step & condition, p, psi_low[idx])
+                    psi_up[idx] = np.where(step & ~condition, p, psi_up[idx])
+                    psi[idx] = np.where(step, (psi_low[idx] + psi_up[idx]) / 2, p)
+
+                # Lagrange coefficients:
+                y = np.where(converged, y, np.nan)
+                f = (1 - y / norm_r0)[:, np.newaxis]
+                g = (A * np.sqrt(y / k))[:, np.newaxis]
+                gdot = (1 - y / norm_r1)[:, np.newaxis]
+
+                v0 = (r1 - f * r0) / g
+                v1 = (gdot * r1 - r0) / g
+
+            return v0, v1
+
+        @staticmethod
+        def stumpff(psi, terms=12):
+            # Stumpff functions c2(psi) and c3(psi) for an array of psi. Small |psi| falls back to the
+            # power series, as in poliastro, to avoid cancellation around zero.
+
+            c2 = np.empty_like(psi)
+            c3 = np.empty_like(psi)
+
+            pos = psi > 1.0
+            neg = psi < -1.0
+            mid = ~(pos | neg)
+
+            sq = np.sqrt(psi[pos])
+            c2[pos] = (1 - np.cos(sq)) / psi[pos]
+            c3[pos] = (sq - np.sin(sq)) / (psi[pos] * sq)
+
+            sq = np.sqrt(-psi[neg])
+            c2[neg] = (np.cosh(sq) - 1) / -psi[neg]
+            c3[neg] = (np.sinh(sq) - sq) / (-psi[neg] * sq)
+
+            # Series: c2 = sum (-psi)^n / (2n + 2)!, c3 = sum (-psi)^n / (2n + 3)!
+            x = -psi[mid]
+            term2 = np.full_like(x, 1 / 2)
+            term3 = np.full_like(x, 1 / 6)
+            c2[mid] = term2
+            c3[mid] = term3
+            for n in range(1, terms):
+                term2 = term2 * x / ((2 * n + 1) * (2 * n + 2))
+                term3 = term3 * x / ((2 * n + 2) * (2 * n + 3))
+                c2[mid] += term2
+                c3[mid] += term3
+
+            return c2, c3
     
-    class Plot:
+    class Sequence:
+        # Gravity-assist sequences, ie: Earth >> Venus >> Earth >> Jupiter. Each leg is a porkchop grid
+        # of excess velocity vectors, and legs are chained by a powered flyby at every intermediate
+        # body. The combined date space is searched leg by leg with branch and bound: partial paths
+        # whose departure C3 or accumulated delta-V already exceed the contour upper bounds are
+        # dropped, and the next leg is only solved from encounter dates that still have a live path.
+
+        # Minimum flyby altitude above the mean radius [km]:
+        min_altitude = 300
+
+        @classmethod
+        def search(cls, k, bodies, dates, bounds, min_altitude=None):
+            # Finds the cheapest sequence of encounter dates for bodies. Returns a dict with the
+            # julian date of every encounter, the transfer type of every leg, departure C3, the
+            # delta-V of every flyby, arrival V infinity and total delta-V, along with the number of
+            # lambert cells solved and the number an exhaustive search would have needed. Returns
+            # None if no sequence satisfies the bounds.
+
+            ## Variables:
+            # bodies      = list of Planet objects, departure first, destination last
+            # dates       = list of julian date arrays, one per body, of candidate encounter dates
+            # bounds      = contour upper bounds, ie: {"c3": 40, "vinf": 15, "dv": 20}
+            # cost        = (2, n_i, n_i-1) cheapest accumulated delta-V of a path whose last leg has
+            #               the given type, arrival date and departure date, inf once pruned
+            # vin         = (2, n_i, n_i-1, 3) arrival excess velocity of that last leg
+            # back        = per flyby, flattened (type, date) of the incoming leg on the cheapest path
+
+            min_altitude = cls.min_altitude if min_altitude is None else min_altitude
+            dates = [np.asarray(jd, dtype=float) for jd in dates]
+
+            # First leg, pruned by departure C3 and by total delta-V:
+            vdep, vin = cls.leg(k, bodies[0], bodies[1], dates[0], dates[1])
+            c3 = np.sum(vdep.astype(float)**2, axis=-1)
+            cost = np.where(np.isfinite(c3) & (c3 <= bounds["c3"]), np.sqrt(c3), np.inf)
+            cost[cost > bounds["dv"]] = np.inf
+            legs, backs = [(vdep, vin)], []
+            evaluated = exhaustive = dates[0].size * dates[1].size
+
+            for i in range(1, len(bodies) - 1):
+                body, n_prev, n_next = bodies[i], dates[i - 1].size, dates[i + 1].size
+                exhaustive += dates[i].size * n_next
+
+                # Only leave from encounter dates some surviving path arrives on:
+                alive = np.flatnonzero(np.isfinite(cost).any(axis=(0, 2)))
+                vdep = np.full((2, n_next, dates[i].size, 3), np.nan, dtype=np.float32)
+                vout = np.full_like(vdep, np.nan)
+                if alive.size:
+                    vdep[:, :, alive], vout[:, :, alive] = cls.leg(k, body, bodies[i + 1], dates[i][alive], dates[i + 1])
+                    evaluated += alive.size * n_next
+
+                new_cost = np.full((2, n_next, dates[i].size), np.inf)
+                back = np.full(new_cost.shape, -1)
+                rp = body.properties["radius"] + min_altitude
+                for j in alive:
+                    incoming = cost[:, j, :].ravel()
+                    live = np.flatnonzero(np.isfinite(incoming))
+                    total = incoming[live, np.newaxis] + cls.flyby(
+                        vin[:, j, :].reshape(-1, 3)[live], vdep[:, :, j].reshape(-1, 3), body.properties["mu"], rp)
+                    total = np.where(np.isfinite(total), total, np.inf)
+                    best = np.argmin(total, axis=0)
+                    new_cost[:, :, j] = total[best, np.arange(total.shape[1])].reshape(2, n_next)
+                    back[:, :, j] = live[best].reshape(2, n_next)
+
+                new_cost[new_cost > bounds["dv"]] = np.inf
+                cost, vin = new_cost, vout
+                legs.append((vdep, vout))
+                backs.append(back)
+
+            # Destination, pruned by arrival V infinity and total delta-V:
+            vinf = np.linalg.norm(vin.astype(float), axis=-1)
+            total = np.where(np.isfinite(vinf) & (vinf <= bounds["vinf"]), cost + vinf, np.inf)
+            total[total > bounds["dv"]] = np.inf
+            if not np.isfinite(total).any():
+                return None
+
+            # Walk back from the cheapest arrival:
+            transfer, a, d = np.unravel_index(np.argmin(total), total.shape)
+            path = [(transfer, a, d)]
+            for i in range(len(backs) - 1, -1, -1):
+                transfer, d_prev = divmod(backs[i][transfer, a, d], dates[i].size)
+                a, d = d, d_prev
+                path.insert(0, (transfer, a, d))
+
+            flybys = []
+            for i in range(1, len(path)):
+                vin_i = legs[i - 1][1][path[i - 1][0], path[i - 1][1], path[i - 1][2]]
+                vout_i = legs[i][0][path[i][0], path[i][1], path[i][2]]
+                rp = bodies[i].properties["radius"] + min_altitude
+                flybys.append(float(cls.flyby(vin_i[np.newaxis], vout_i[np.newaxis], bodies[i].properties["mu"], rp)[0, 0]))
+
+            first, last = path[0], path[-1]
+            return {
+                "bodies": [body.properties["name"] for body in bodies],
+                "dates": [float(dates[0][first[2]])] + [float(dates[i + 1][step[1]]) for i, step in enumerate(path)],
+                "types": [int(step[0]) + 1 for step in path],
+                "c3": float(np.sum(legs[0][0][first].astype(float)**2)),
+                "flyby_dv": flybys,
+                "vinf": float(vinf[last]),
+                "dv": float(total[last]),
+                "evaluated": int(evaluated),
+                "exhaustive": int(exhaustive),
+            }
+
         @staticmethod
-        @st.cache(suppress_st_warning=True)
-        def porkchop(config, dd, ad, c3s0, c3l0, vinfs1, vinfl1, dVs, dVl, tofs):
+        def leg(k, Body0, Body1, jd0, jd1):
+            # Excess velocity vectors of every transfer from Body0 on jd0 to Body1 on jd1, for both
+            # transfer types, as float32 (2, len(jd1), len(jd0), 3) arrays at departure and arrival.
+            # Legs are kept in the disk cache so repeated searches sharing a leg only solve it once.
+
+            namespace = os.path.join("legs", Cache.key(k, Body0.properties["name"], Body1.properties["name"],
+                                                      Ephemeris.identity()))
+            key = Cache.key(jd0, jd1)
+            cached = Cache.load(namespace, key)
+            if cached is not None:
+                return cached["vdep"], cached["varr"]
+
+            rP0, vP0 = Body0.getStates(jd0)
+            rP1, vP1 = Body1.getStates(jd1)
+            cells = (len(jd1), len(jd0))
+            di = np.tile(np.arange(cells[1]), cells[0])
+            ai = np.repeat(np.arange(cells[0]), cells[1])
+            tofs = (np.asarray(jd1)[ai] - np.asarray(jd0)[di]) * 86400
+
+            vdep = np.empty((2,) + cells + (3,), dtype=np.float32)
+            varr = np.empty_like(vdep)
+            for row, short in enumerate((True, False)):
+                v0, v1 = Tools.Transfer.lambertBatch(k, rP0[di], rP1[ai], tofs, short)
+                vdep[row] = (v0 - vP0[di]).reshape(cells + (3,))
+                varr[row] = (v1 - vP1[ai]).reshape(cells + (3,))
+
+            Cache.save(namespace, key, vdep=vdep, varr=varr)
+            return vdep, varr
+
+        @staticmethod
+        def flyby(vin, vout, mu, rp):
+            # Delta-V of powered flybys turning each incoming excess velocity in vin (m, 3) into each
+            # outgoing one in vout (p, 3), as an (m, p) array. The burn is applied at the periapsis
+            # rp; the two hyperbolae can turn the velocity by at most the sum of their half-turn
+            # angles, and any turn beyond that is charged as a plane change of the outgoing velocity.
+
+            ## Variables:
+            # delta     = required turn angle
+            # delta_max = largest turn the flyby provides at rp
+
+            vin = np.asarray(vin, dtype=float)
+            vout = np.asarray(vout, dtype=float)
+            s_in = np.linalg.norm(vin, axis=-1)[:, np.newaxis]
+            s_out = np.linalg.norm(vout, axis=-1)[np.newaxis, :]
+
+            with np.errstate(invalid="ignore", divide="ignore"):
+                delta = np.arccos(np.clip(vin @ vout.T / (s_in * s_out), -1, 1))
+                delta_max = np.arcsin(1 / (1 + rp * s_in**2 / mu)) + np.arcsin(1 / (1 + rp * s_out**2 / mu))
+                periapsis = np.abs(np.sqrt(s_out**2 + 2 * mu / rp) - np.sqrt(s_in**2 + 2 * mu / rp))
+                return periapsis + 2 * s_out * np.sin(np.maximum(delta - delta_max, 0) / 2)
+    
+    class Plot:
+        # Colors of each metric's contour lines:
+        colors = {"c3": "red", "vinf": "blue", "dv": "green", "tof": "black"}
+
+        @classmethod
+        @(st.cache(suppress_st_warning=True) if st else lambda function: function)
+        def porkchop(cls, config, dd, ad, c3s0, c3l0, vinfs1, vinfl1, dVs, dVl, tofs):
+            # Cached figure of a complete grid, see figure.
+            with Diagnostics.stage("plot.figure"):
+                return cls.figure(config, dd, ad, c3s0, c3l0, vinfs1, vinfl1, dVs, dVl, tofs)
+
+        @classmethod
+        def figure(cls, config, dd, ad, c3s0, c3l0, vinfs1, vinfl1, dVs, dVl, tofs):
             # Takes dates, characteristic energy, excess arrival velocity, velocity increment, and times of flight
             # to return contour plots as a brute force method for optimizing departure and arrival dates
             # for an arbitrary mission between two planets in the solar system.
+            # Only the enabled metrics are plotted, every grid is decimated to at most config["plt_pts"]
+            # points per axis, and hover text for all metrics comes from a single transparent layer, so
+            # the size of the figure is bounded regardless of the grid resolution.
 
             ## Variables:
             ## ad, dd = departure, arrival date arrays
@@ -109,6 +1128,7 @@ class Tools:
             ## dVs, dVl = type 1 (short path), type 2 (long path) velocity increment (delta-v) arrays
             ## vinfs1, vinfl1 = type 1 (short path), type 2 (long path) excess velocity arrays
             ## tofs = array of flight times for given dates
+            ## di, ai = strides of the departure, arrival axes after decimation
 
             # Plot formatting:
             layout = go.Layout(
@@ -130,230 +1150,155 @@ class Tools:
             plot_bgcolor= 'rgba(255,255,255,0)',
             paper_bgcolor= 'rgba(255,255,255,0)',
             height=config["plt_size"]["height"],
-            hovermode="x", # compare along x axis on hover
+            hovermode="closest",
             hoverlabel=dict(
                 bgcolor="black",
                 font_color="white",
                 )
             )
 
-            # Create Traces (Not very DRY, later version will simplify)
-
-            c3_color = "red"
-            vinf_color = "blue"
-            dv_color = "green"
-
-            c3s_trace = go.Contour(
-                    name="C3 [km2/s2]",
-                    x = dd,
-                    y = ad,
-                    z = c3s0,
-                    hovertemplate='C3, Type 1: %{z} km2/s2<extra></extra>',
-                    showscale=False,
-                    showlegend=True,
-                    colorscale=[[0, c3_color], [1.0, c3_color]],
-                    contours_coloring='lines',
-                    line_width=1,
-                    contours=dict(
-                        start=0,
-                        end=config["c3_ub"],
-                        size=config["inc"],
-                        showlabels = config["c3_lbl"],
-                        labelfont = dict(
-                            size = 10,
-                            color = c3_color
-                        )))
-
-            c3l_trace = go.Contour(
-                    name="C3 [km2/s2]",
-                    x = dd,
-                    y = ad,
-                    z = c3l0,
-                    hovertemplate='C3, Type 2: %{z} km2/s2<extra></extra>',
-                    showscale=False,
-                    colorscale = [[0, c3_color], [1.0, c3_color]],
-                    contours_coloring='lines',
-                    line_width=1,
-                    contours=dict(
-                        start=0,
-                        end=config["c3_ub"],
-                        size=config["inc"],
-                        showlabels = config["c3_lbl"],
-                        labelfont = dict(
-                            size = 10,
-                            color = c3_color
-                        )))
+            # Decimate to the display resolution:
+            max_pts = config.get("plt_pts", 400)
+            di = -(-len(dd) // max_pts)
+            ai = -(-len(ad) // max_pts)
+            dd = np.asarray(dd)[::di]
+            ad = np.asarray(ad)[::ai]
+            grids = {
+                "c3": (c3s0, c3l0),
+                "vinf": (vinfs1, vinfl1),
+                "dv": (dVs, dVl),
+            }
+            grids = {metric: tuple(cls.compact(grid[::ai, ::di]) for grid in pair) for metric, pair in grids.items()}
+            tofs = cls.compact(np.asarray(tofs)[::ai, ::di])
 
-            vinfs_trace = go.Contour(
-                    name="V Infinity [km/s]",
-                    x = dd,
-                    y = ad,
-                    z = vinfs1,
-                    hovertemplate='V Infinity, Type 1: %{z} km/s<extra></extra>',
-                    showscale=False,
-                    showlegend=True,
-                    colorscale=[[0, vinf_color], [1.0, vinf_color]],
-                    contours_coloring='lines',
-                    line_width=1,
-                    contours=dict(
-                        start=0,
-                        end=config["vinf_ub"],
-                        size=config["inc"],
-                        showlabels=config["vinf_lbl"],
-                        labelfont=dict(
-                            size=10,
-                            color=vinf_color
-                        )))
+            # Contour traces, type 2 first so type 1 is drawn on top:
+            names = {"c3": "C3 [km2/s2]", "vinf": "V Infinity [km/s]", "dv": "Delta V [km/s]"}
+            plottable_traces = []
+            for metric in ("dv", "vinf", "c3"):
+                if config["make_plt"][metric]:
+                    for z, legend in zip(reversed(grids[metric]), (False, True)):
+                        plottable_traces.append(cls.contour(
+                            names[metric], dd, ad, z, cls.colors[metric],
+                            config[metric + "_ub"], config["inc"], config[metric + "_lbl"], legend))
+            if config["make_plt"]["tof"]:
+                plottable_traces.append(cls.contour(
+                    "TOF [days]", dd, ad, tofs, cls.colors["tof"],
+                    np.nanmax(tofs), config["tof_inc"], config["tof_lbl"], True))
 
-            vinfl_trace = go.Contour(
-                    name="V Infinity [km/s]",
-                    x = dd,
-                    y = ad,
-                    z = vinfl1,
-                    hovertemplate='V Infinty, Type 2: %{z} km/s<extra></extra>',
-                    showscale=False,
-                    colorscale=[[0, vinf_color], [1.0, vinf_color]],
-                    contours_coloring='lines',
-                    line_width=1,
-                    contours=dict(
-                        start=0,
-                        end=config["vinf_ub"],
-                        size=config["inc"],
-                        showlabels=config["vinf_lbl"],
-                        labelfont=dict(
-                            size=10,
-                            color=vinf_color
-                        )))
+            # One transparent layer carries the hover text of every metric:
+            hovertemplate = "%{x} >> %{y}: %{z} days"
+            customdata = []
+            for metric, label, unit in (("c3", "C3", "km2/s2"), ("vinf", "V Infinity", "km/s"), ("dv", "Delta V", "km/s")):
+                if config["make_plt"][metric]:
+                    for kind, grid in zip((1, 2), grids[metric]):
+                        hovertemplate += "<br>%s, Type %d: %%{customdata[%d]} %s" % (label, kind, len(customdata), unit)
+                        customdata.append(grid)
+            plottable_traces.append(go.Heatmap(
+                x = dd,
+                y = ad,
+                z = tofs,
+                customdata = np.stack(customdata, axis=-1) if customdata else None,
+                hovertemplate = hovertemplate + "<extra></extra>",
+                hoverongaps = False,
+                opacity = 0,
+                showscale = False,
+                showlegend = False,
+            ))
 
-            dVs_trace = go.Contour(
-                    name="Delta V [km/s]",
-                    x = dd,
-                    y = ad,
-                    z = dVs,
-                    hovertemplate='Delta V, Type 1: %{z} km/s<extra></extra>',
-                    showscale=False,
-                    showlegend=True,
-                    colorscale=[[0, dv_color], [1.0, dv_color]],
-                    contours_coloring='lines',
-                    line_width=1,
-                    contours=dict(
-                        start=0,
-                        end=config["dv_ub"],
-                        size=config["inc"],
-                        showlabels=config["dv_lbl"],
-                        labelfont=dict(
-                            size=10,
-                            color=dv_color
-                        )))
+            # Plot Traces:
+            return go.Figure(data=plottable_traces, layout=layout)
 
-            dVl_trace = go.Contour(
-                    name="Delta V [km/s]",
-                    x = dd,
-                    y = ad,
-                    z = dVl,
-                    hovertemplate='Delta V, Type 2: %{z} km/s<extra></extra>',
-                    showscale=False,
-                    colorscale=[[0, dv_color], [1.0, dv_color]],
-                    contours_coloring='lines',
-                    line_width=1,
-                    contours=dict(
-                        start=0,
-                        end=config["dv_ub"],
-                        size=config["inc"],
-                        showlabels=config["dv_lbl"],
-                        labelfont=dict(
-                            size=10,
-                            color=dv_color
-                        )))
+        @staticmethod
+        def contour(name, dd, ad, z, color, end, size, showlabels, showlegend):
+            # Returns a line contour trace of z from 0 to end. Hover is left to porkchop's hover layer.
 
-            tof_trace = go.Contour(
-                    name="TOF [days]",
+            return go.Contour(
+                    name=name,
                     x = dd,
                     y = ad,
-                    z = tofs,
-                    hovertemplate='%{x} >> %{y}: %{z} days<extra></extra>',
+                    z = z,
+                    hoverinfo="skip",
                     showscale=False,
-                    showlegend=True,
-                    colorscale=[[0, 'black'], [1.0, 'black']],
+                    showlegend=showlegend,
+                    colorscale=[[0, color], [1.0, color]],
                     contours_coloring='lines',
                     line_width=1,
                     contours=dict(
                         start=0,
-                        end=tofs.max(),
-                        size=config["tof_inc"],
-                        showlabels=config["tof_lbl"],
+                        end=end,
+                        size=size,
+                        showlabels=showlabels,
                         labelfont=dict(
                             size=10,
-                            color="black"
+                            color=color
                         )))
-            
-            # Prepare Traces:
-            plottable_traces = []
-            if config["make_plt"]["dv"]:
-                plottable_traces.append(dVl_trace)
-                plottable_traces.append(dVs_trace)
-            if config["make_plt"]["vinf"]:
-                plottable_traces.append(vinfl_trace)
-                plottable_traces.append(vinfs_trace)
-            if config["make_plt"]["c3"]:
-                plottable_traces.append(c3l_trace)
-                plottable_traces.append(c3s_trace)
-            plottable_traces.append(tof_trace)
 
-            # Plot Traces:
-            fig = go.Figure(data=plottable_traces, layout=layout)
-
-            # If TOF not enabled, hide it.
-            # Note: this is still plotted invisibly so the TOF data is displayed on hover
-            # but not on the plot itself.
-            if not config["make_plt"]["tof"]:
-                fig.update_traces(
-                    selector=len(plottable_traces)-1,
-                    overwrite=True,
-                    colorscale=[[0, 'rgba(0,0,0,0)'], [1.0, 'rgba(0,0,0,0)']],
-                    name=""
-                )
+        @staticmethod
+        def compact(grid, decimals=3):
+            # Rounds a grid and narrows it to float32, which is all the precision a plot needs and
+            # keeps the serialized figure small.
 
-            return fig
+            return np.round(np.asarray(grid, dtype=np.float32), decimals)
     
     class Date:
+        # Julian date of the numpy datetime64 epoch, 1970-01-01T00:00:
+        epoch = 2440587.5
 
         @classmethod
         def getRange(cls, start, end, increment):
-            # Takes a start date and end date, along with an incrementm, and returns a list
-            # of dates and julian dates between the two dates (inclusive). The spacing between
-            # days is controlled by the increment variable.
+            # Takes a start date and end date, along with an increment, and returns an array of
+            # datetime64 dates and an array of julian dates between the two dates (inclusive). The
+            # spacing between dates is controlled by the increment variable, which may be a
+            # fraction of a day. Everything is done with datetime64 arithmetic, to the second.
 
             ## Variables
-            # increment: an int to create array of datetime objects with increment
+            # increment: days between dates (ie: 2, 0.25) or a string, ie: "2", "6h", see days
             # start, end = date strings ... ex: "2021-10-1"
-            # start_date, end_date = datetime objects of start, end variables
-            # date_list = array of datetime objects
+            # start_date, end_date = datetime64 of start, end variables
+            # step = increment as a timedelta64 [s]
+            # date_list = array of datetime64 dates
             # jdate_list = an array of julian dates
 
             # Split the strings into a string arrays -> ex: ["2021", "10", "1"]
             start = start.split('-')
             end = end.split('-')
 
-            # Convert string arrays into datetime objects:
-            start_date = datetime.date(int(start[0]), int(start[1]), int(start[2]))
-            end_date = datetime.date(int(end[0]), int(end[1]), int(end[2]))
+            # Convert string arrays into datetime64:
+            start_date = np.datetime64(datetime.date(int(start[0]), int(start[1]), int(start[2])), "s")
+            end_date = np.datetime64(datetime.date(int(end[0]), int(end[1]), int(end[2])), "s")
+            step = np.timedelta64(int(round(cls.days(increment) * 86400)), "s")
 
-            # Generate an array of dates:
-            date_list = np.arange(start_date, end_date + datetime.timedelta(increment), increment)
-            jdate_list = [cls.date2julian(date) for date in date_list]
+            # Generate an array of dates, never past the end date:
+            date_list = np.arange(start_date, end_date + np.timedelta64(1, "s"), step)
+            jdate_list = cls.julian(date_list)
 
             return date_list, jdate_list
 
+        @staticmethod
+        def days(increment):
+            # Takes an increment, either a number of days or a string of a number of days or hours,
+            # ie: "2", "0.5", "2d" or "6h", and returns it in days.
+
+            text = str(increment).strip().lower()
+            unit = {"d": 1, "h": 1 / 24}.get(text[-1:], None)
+            days = float(text[:-1] if unit else text) * (unit or 1)
+            if not days > 0:
+                raise ValueError("Date increment must be positive, got %r" % increment)
+            return days
+
+        @classmethod
+        def julian(cls, dates):
+            # Takes an array of datetime64 dates and returns an array of julian dates.
+
+            return (np.asarray(dates, dtype="datetime64[s]") - np.datetime64(0, "s")).astype(float) / 86400 + cls.epoch
+
         @staticmethod
         def date2julian(date):
-            # Takes a single date string and converts it to a julian date.
+            # Takes a single date and converts it to a julian date.
 
             ## Variables:
-            # date: a date string to be converted to a Julian Date
+            # date: a date (datetime64, datetime or ISO date string) to be converted to a Julian Date
             # jdate = a julian date
 
-            # We convert the date into J2000, and sum the return of gcal2jd function call for final Julian date
-            date = date.tolist()
-            jdate = sum(jd.gcal2jd(date.year, date.month, date.day))
-            return jdate
\ No newline at end of file
+            jdate = float(Tools.Date.julian(np.datetime64(date)))
+            return jdate
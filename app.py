@@ -1,10 +1,15 @@
 from Tools import *
 from Planet import *
 from Initialize import *
+from Diagnostics import Diagnostics
+from Service import Service
 import streamlit as st
+import time
+import os
 
 # Initialize Configuration
 config = Initialize.config()
+diagnostics = Diagnostics.start() # what this session records during this run, for the panel below
 
 # Initialize Data:
 dd, jdd = Tools.Date.getRange(config["dd"][0], config["dd"][1], config["d_inc"]) # Departure dates
@@ -12,12 +17,69 @@ ad, jad = Tools.Date.getRange(config["ad"][0], config["ad"][1], config["d_inc"])
 Body0 = Planet(config["db"]) # Depature Body
 Body1 = Planet(config["ab"]) # Arrival Body
 
-# Solve for departure/arrival body position and velocity, as well as 
-# requisite characteristic energy, arrival excess velocity, velocity increment, and time of flight.
-(rP0, vP0, rP1, vP1, c3s0, c3l0, vinfs1, vinfl1, dVs, dVl, tofs) = Tools.Transfer.solve(config["k"], Body0, Body1, jdd, jad)
+# Solve for the requisite characteristic energy, arrival excess velocity, and velocity increment.
+# Cells that cannot come in under the upper bound of any enabled contour plot are skipped.
+# With MISSION_PLANNER_SERVICE set to the address of a running Service, ie: http://127.0.0.1:8765,
+# the solving is left to that service and this script only plots.
+bounds = {metric: config[metric + "_ub"] for metric in ("c3", "vinf", "dv") if config["make_plt"][metric]}
+refine_bounds = bounds or {metric: config[metric + "_ub"] for metric in ("c3", "vinf", "dv")} # refine needs a bound
+stride = max(1, int(config["coarse_inc"] // config["d_inc"]))
+service = Service.Client(os.environ["MISSION_PLANNER_SERVICE"]) if os.environ.get("MISSION_PLANNER_SERVICE") else None
+if service is not None:
+    with st.spinner("Waiting for the solver service..."):
+        if config["adaptive"]:
+            result = service.refine(config["k"], Body0, Body1, jdd, jad, refine_bounds, stride, max_revs=config["max_revs"])
+        else:
+            result = service.solve(config["k"], Body0, Body1, jdd, jad, config["max_revs"], bounds)
+elif config["adaptive"]:
+    result = Tools.Transfer.refine(config["k"], Body0, Body1, jdd, jad, refine_bounds, stride, workers=config["workers"],
+                                   max_revs=config["max_revs"])
+else:
+    result = None # solved progressively below
 
 # Create Plot
 config["plt_title"] = "Mission: " + config["db"] + " to " + config["ab"] + " " + str(dd[0].tolist().year) + ", Type 1, 2 Transfers"
 st.title(config["plt_title"])
 st.write("By [Aaron Scott](https://www.linkedin.com/in/aaron-scott-899797216/), visit the [GitHub repository](https://www.github.com/astroscott/Mission_Planner) for full source code.")
-st.plotly_chart(Tools.Plot.porkchop(config, dd, ad, c3s0, c3l0, vinfs1, vinfl1, dVs, dVl, tofs), use_container_width=True)
\ No newline at end of file
+
+if result is None:
+    # Redraw the plot with partial grids as blocks of arrival dates finish. Changing any input makes
+    # streamlit stop this script at its next call, which closes the stream and cancels pending blocks.
+    progress, status, chart = st.progress(0), st.empty(), st.empty()
+    stream = Tools.Transfer.stream(config["k"], Body0, Body1, jdd, jad, config["workers"], config["max_revs"], bounds)
+    start = drawn = time.time()
+    reused = None
+    try:
+        for result, done, total in stream:
+            progress.progress(done / total)
+            reused = done if reused is None else reused
+            if done < total:
+                rate = (done - reused) / (time.time() - start) # transfers solved per second
+                status.text("Solved %d of %d transfers%s" % (
+                    done, total, ", about %.0f s left" % ((total - done) / rate) if rate else ""))
+                if time.time() - drawn > config["redraw"]: # partial figures bypass the figure cache
+                    with Diagnostics.stage("plot.figure"):
+                        figure = Tools.Plot.figure(config, dd, ad, *result.grids())
+                    chart.plotly_chart(figure, use_container_width=True)
+                    drawn = time.time()
+    finally:
+        stream.close()
+    progress.empty()
+    status.empty()
+else:
+    chart = st.empty()
+
+with Diagnostics.stage("plot.porkchop"):
+    figure = Tools.Plot.porkchop(config, dd, ad, *result.grids())
+chart.plotly_chart(figure, use_container_width=True)
+
+if result.skipped:
+    st.caption("%d of %d transfers were skipped without solving, as they cannot fall under any contour upper bound." % (
+        result.skipped, result.metrics[0].size))
+
+if config["diagnostics"]:
+    with st.expander("Diagnostics", expanded=True):
+        st.json(diagnostics.snapshot())
+        if Diagnostics.samples:
+            st.write("Most sampled functions (MISSION_PLANNER_PROFILE):")
+            st.table([{"function": function, "samples": hits} for function, hits in Diagnostics.top()])
@@ -0,0 +1,54 @@
+import numpy as np
+import pytest
+
+# poliastro is the scalar reference:
+pytest.importorskip("poliastro")
+
+from Tools import Tools
+from Lambert import Lambert
+
+k = 1.32712440018e11 # [km^3/s^2]
+
+
+def transfers(n=300, seed=0):
+    # Random heliocentric transfers between 0.4 and 6 au with flight times of 60 to 1500 days,
+    # followed by cells neither path can solve: zero and negative flight times, and transfers
+    # of exactly 180 degrees.
+
+    rng = np.random.default_rng(seed)
+    au = 1.495978707e8 # [km]
+
+    def positions(count):
+        directions = rng.normal(size=(count, 3)) * [1, 1, 0.05]
+        radii = au * rng.uniform(0.4, 6, count)
+        return directions / np.linalg.norm(directions, axis=1, keepdims=True) * radii[:, np.newaxis]
+
+    rP0, rP1 = positions(n), positions(n)
+    vP0, vP1 = rng.normal(scale=20, size=(n, 3)), rng.normal(scale=20, size=(n, 3))
+    tofs = rng.uniform(60, 1500, n) * 86400
+
+    failing_r0 = np.array([[au, 0, 0], [au, 0, 0], [0, 1.2 * au, 0], [-0.7 * au, 0, 0]])
+    failing_r1 = np.array([[0, 1.5 * au, 0], [0, 1.5 * au, 0], [0, -2.5 * au, 0], [1.5 * au, 0, 0]])
+    failing_tofs = np.array([0, -100 * 86400, 200 * 86400, 300 * 86400])
+
+    return (np.vstack((rP0, failing_r0)), np.vstack((rP1, failing_r1)),
+            np.vstack((vP0, np.full((4, 3), 25.0))), np.vstack((vP1, np.full((4, 3), 20.0))),
+            np.r_[tofs, failing_tofs])
+
+
+@pytest.mark.parametrize("engine", ["numpy", pytest.param("numba", marks=pytest.mark.skipif(
+    not Lambert.available, reason="numba is not installed"))])
+def test_batch_matches_scalar(engine, monkeypatch):
+    monkeypatch.setattr(Tools.Transfer, "engine", engine)
+    rP0, rP1, vP0, vP1, tofs = transfers()
+
+    expected = np.array([Tools.Transfer.solveLambert(k, rP0[i], rP1[i], vP0[i], vP1[i], tofs[i])
+                         for i in range(len(tofs))], dtype=float).T # failures come back as None, ie: NaN
+    actual = np.array(Tools.Transfer.solveBatch(k, rP0, rP1, vP0, vP1, tofs))
+
+    np.testing.assert_array_equal(np.isnan(actual), np.isnan(expected))
+    np.testing.assert_allclose(actual, expected, rtol=1e-7, equal_nan=True)
+
+    # The cells that cannot be solved are NaN on both paths, in all six metrics, and most others solve:
+    assert np.isnan(actual[:, -4:]).all()
+    assert np.isfinite(actual[:, :-4]).mean() > 0.5
@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+
+from Tools import Tools
+
+k = 1.32712440018e11 # [km^3/s^2]
+au = 1.495978707e8 # [km]
+
+
+def positions(rng, count, low=0.7, high=1.7):
+    # Random heliocentric positions between low and high au, close to the ecliptic.
+
+    directions = rng.normal(size=(count, 3)) * [1, 1, 0.05]
+    radii = au * rng.uniform(low, high, count)
+    return directions / np.linalg.norm(directions, axis=1, keepdims=True) * radii[:, np.newaxis]
+
+
+def revolutions(r0, v0, r1, tof):
+    # Number of full revolutions the orbit through (r0, v0) makes on its way to r1 in tof, from
+    # Kepler's equation: n tof = E1 - E0 - e (sin E1 - sin E0), where E1 - E0 is the eccentric
+    # anomaly swept, the angle from r0 to r1 plus 2 pi for every full revolution.
+
+    ## Variables:
+    # a, n     = semi-major axis, mean motion of the transfer orbit
+    # h, e     = angular momentum, eccentricity vector of the transfer orbit
+    # E0, E1   = eccentric anomalies at r0, r1, within [0, 2 pi)
+
+    norm_r0 = np.linalg.norm(r0, axis=-1)
+    a = 1 / (2 / norm_r0 - np.sum(v0**2, axis=-1) / k)
+    n = np.sqrt(k / a**3)
+
+    # True anomalies measured from e in the direction of motion, r1 lies in the orbit plane:
+    h = np.cross(r0, v0)
+    e = np.cross(v0, h) / k - r0 / norm_r0[:, np.newaxis]
+    ecc = np.linalg.norm(e, axis=-1)
+
+    def eccentric(r):
+        nu = np.arctan2(np.sum(np.cross(e, r) * h, axis=-1) / np.linalg.norm(h, axis=-1), np.sum(e * r, axis=-1))
+        return np.mod(2 * np.arctan(np.sqrt((1 - ecc) / (1 + ecc)) * np.tan(nu / 2)), 2 * np.pi)
+
+    E0, E1 = eccentric(r0), eccentric(r1)
+
+    swept = np.mod(E1 - E0, 2 * np.pi)
+    return (n * tof + ecc * (np.sin(E1) - np.sin(E0)) - swept) / (2 * np.pi)
+
+
+@pytest.mark.parametrize("revs", [1, 2])
+@pytest.mark.parametrize("short", [True, False])
+def test_multi_rev_solutions_make_exactly_revs_revolutions(revs, short):
+    rng = np.random.default_rng(revs)
+    n = 200
+    r0, r1 = positions(rng, n), positions(rng, n)
+    tofs = rng.uniform(1.5, 6, n) * 365.25 * 86400 # [s]
+
+    solved = 0
+    for v0, v1 in Tools.Transfer.lambertRevs(k, r0, r1, tofs, revs, short):
+        cells = np.isfinite(v0).all(axis=-1)
+        solved += np.count_nonzero(cells)
+
+        np.testing.assert_allclose(revolutions(r0[cells], v0[cells], r1[cells], tofs[cells]), revs, atol=1e-6)
+
+        # Energy is conserved between both ends:
+        energy = lambda r, v: np.sum(v**2, axis=-1) / 2 - k / np.linalg.norm(r, axis=-1)
+        np.testing.assert_allclose(energy(r1[cells], v1[cells]), energy(r0[cells], v0[cells]), rtol=1e-8)
+
+    assert solved > n / 4
+
+
+@pytest.mark.parametrize("bounds", [{"c3": 20}, {"vinf": 5}, {"dv": 12}, {"c3": 15, "vinf": 4, "dv": 9}])
+def test_prune_keeps_every_cell_within_bounds(bounds):
+    rng = np.random.default_rng(0)
+    num_departures, num_arrivals = 40, 30
+    rP0, rP1 = positions(rng, num_departures, 0.9, 1.1), positions(rng, num_arrivals, 1.3, 1.7)
+
+    # Circular prograde orbits, slightly inclined:
+    def circular(r):
+        along = np.cross([0, 0.05, 1], r)
+        along /= np.linalg.norm(along, axis=1, keepdims=True)
+        return along * np.sqrt(k / np.linalg.norm(r, axis=1, keepdims=True))
+
+    vP0, vP1 = circular(rP0), circular(rP1)
+    tofs = rng.uniform(-50, 1500, (num_arrivals, num_departures)) # [days]
+
+    keep = Tools.Transfer.prune(k, rP0, rP1, vP0, vP1, tofs, bounds, margin=0)
+
+    d, a = np.meshgrid(np.arange(num_departures), np.arange(num_arrivals))
+    metrics = np.array(Tools.Transfer.solveBatch(k, rP0[d.ravel()], rP1[a.ravel()], vP0[d.ravel()], vP1[a.ravel()],
+                                                 tofs.ravel() * 86400, max_revs=2)[:6]).reshape(6, *tofs.shape)
+    within = Tools.Transfer.withinBounds(metrics, bounds) & (tofs > 0)
+
+    assert within.any() and not keep.all() # the bounds neither keep everything nor nothing
+    assert not (within & ~keep).any()